@@ -6,28 +6,39 @@ except ImportError:
 import os
 import sys
 import re
+import ast
+import json
 import traceback
 import logging
-from base64 import b64decode
+import time
+import hashlib
+import difflib
+import threading
+import itertools
+from collections import OrderedDict, deque
 from contextlib import contextmanager
 
 from PyQt6.QtWidgets import QApplication, QMainWindow, QTextEdit, QFrame, QMessageBox, QFileDialog
-from PyQt6.QtCore import (Qt, QObject, QRect, QMimeData, QEvent, QUrl, QSize,
-                          QVariantAnimation, QEasingCurve,
+from PyQt6.QtCore import (Qt, QObject, QRect, QMimeData, QEvent, QUrl, QSize, QFileSystemWatcher,
+                          QVariantAnimation, QEasingCurve, QByteArray,
                           QTimer, QRunnable, QThreadPool, pyqtSlot, pyqtSignal)
 from PyQt6.QtGui import (QFont, QFontMetrics, QFontDatabase, QImage, QGuiApplication,
     QPainter, QColor, QKeyEvent, QResizeEvent, QCloseEvent,
     QTextCursor, QTextLength, QTextCharFormat, QTextFrameFormat, QTextBlockFormat,
     QTextDocument, QTextImageFormat, QTextTableCell, QTextTableFormat, QTextTableCellFormat)
 
-from qtconsole.pygments_highlighter import PygmentsHighlighter
+# qtpy (which qtconsole is built on) promotes the scoped enums of QtCore, like Qt.Key_Z
+import qtpy.QtCore
+from qtconsole.pygments_highlighter import PygmentsHighlighter, PygmentsBlockUserData
+try:
+    # private, lexes a line continuing the state of the previous one
+    from qtconsole.pygments_highlighter import _lexpatch
+except ImportError:
+    _lexpatch = None
+from qtconsole.qstringhelpers import qstring_length
 from qtconsole.base_frontend_mixin import BaseFrontendMixin
-from qtconsole.manager import QtKernelManager
-from qtconsole.completion_widget import CompletionWidget
-from qtconsole.call_tip_widget import CallTipWidget
-from qtconsole.ansi_code_processor import QtAnsiCodeProcessor
 
-from ansi2html import Ansi2HTMLConverter
+from jupad.daemon import kernel_launch_args, claim_kernel
 
 light_theme = {
     'code_background': QColor('#ffffff'),
@@ -74,60 +85,389 @@ class AnimateExecutingCell(QVariantAnimation):
             with self.jupad.join_edit_block():
                 self.jupad.set_cell_color(self.jupad.execute_cell_idx, value)
 
+class LatexCache:
+    '''content addressed latex->png cache, in memory (lru) and on disk (least recently used files are pruned)'''
+    def __init__(self, dir_path, max_entries=256, max_disk_entries=4096):
+        self.dir_path = dir_path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.disk_entries = None # counted on the first put
+        self.memory = OrderedDict()
+        self.lock = threading.Lock() # accessed from latex workers
+
+    @staticmethod
+    def key(latex, color, scale):
+        return hashlib.sha256(f'{color}\0{scale}\0{latex}'.encode()).hexdigest()
+
+    def get_from_memory(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        return None
+
+    def get(self, key):
+        image_data = self.get_from_memory(key)
+        if image_data is None:
+            path = os.path.join(self.dir_path, key + '.png')
+            try:
+                with open(path, 'rb') as f:
+                    image_data = f.read()
+                os.utime(path) # used, pruned last
+            except OSError:
+                return None
+            self.put_in_memory(key, image_data)
+        return image_data
+
+    def put_in_memory(self, key, image_data):
+        with self.lock:
+            self.memory[key] = image_data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def put(self, key, image_data):
+        self.put_in_memory(key, image_data)
+        try:
+            os.makedirs(self.dir_path, exist_ok=True)
+            # write and rename, concurrent workers/processes never see partial files
+            tmp_path = os.path.join(self.dir_path, f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, os.path.join(self.dir_path, key + '.png'))
+        except OSError:
+            logging.getLogger('jupad').exception('latex cache write error')
+            return
+        with self.lock:
+            if self.disk_entries is None:
+                self.disk_entries = len(self.disk_paths())
+            else:
+                self.disk_entries += 1
+            prune = self.disk_entries > self.max_disk_entries
+        if prune:
+            self.prune_disk()
+
+    def disk_paths(self):
+        try:
+            return [os.path.join(self.dir_path, name) for name in os.listdir(self.dir_path) if name.endswith('.png')]
+        except OSError:
+            return []
+
+    def prune_disk(self):
+        '''remove the least recently used files, down to 3/4 of max_disk_entries, so it isn't done on every put'''
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0
+        paths = sorted(self.disk_paths(), key=mtime)
+        removed = paths[:max(0, len(paths) - self.max_disk_entries*3//4)]
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # removed by another process
+        with self.lock:
+            self.disk_entries = len(paths) - len(removed)
+
 class LatexWorkerSignals(QObject):
     # separate class as you must be QObject to have signals
     result = pyqtSignal(int, str, bytes)
 
 class LatexWorker(QRunnable):
-    def __init__(self, cell_idx, latex):
+    def __init__(self, cell_idx, latex, cache, color, scale):
         super().__init__()
         self.cell_idx = cell_idx
         self.latex = latex
+        self.cache = cache
+        self.color = color
+        self.scale = scale
+        self.cancelled = False
+        self.done = False
         self.signals = LatexWorkerSignals()
 
     @pyqtSlot()
     def run(self):
         try:
-            from IPython.lib.latextools import latex_to_png
-            image_data = latex_to_png(self.latex, wrap=False, backend='dvipng')
+            if self.cancelled:
+                return
+            key = self.cache.key(self.latex, self.color, self.scale)
+            image_data = self.cache.get(key)
             if image_data is None:
-                image_data = latex_to_png(self.latex, wrap=False, backend='matplotlib')
-            if image_data:
+                from IPython.lib.latextools import latex_to_png
+                image_data = latex_to_png(self.latex, wrap=False, backend='dvipng', color=self.color, scale=self.scale)
+                if image_data is None:
+                    image_data = latex_to_png(self.latex, wrap=False, backend='matplotlib', color=self.color, scale=self.scale)
+                if image_data:
+                    self.cache.put(key, image_data)
+            if image_data and not self.cancelled:
                 self.signals.result.emit(self.cell_idx, self.latex, image_data)
         except Exception:
             logging.getLogger('jupad').exception('latex error')
+        finally:
+            self.done = True
 
-class Highlighter(PygmentsHighlighter):
-    def highlightBlock(self, string):
-        # don't highlight output cells
-        cursor = QTextCursor(self.currentBlock())
-        cell = self.parent().table.cellAt(cursor)
-        if cell.isValid() and cell.column() == 0:
-            return super().highlightBlock(string)
-
-class CompletionWidget_(CompletionWidget):
-    def _complete_current(self):
-        super()._complete_current()
-        self._text_edit.execute(self._text_edit.complete_cell_idx)
-
-class CallTipWidget_(CallTipWidget):
+class KernelLauncherSignals(QObject):
+    result = pyqtSignal(object)
+
+class KernelLauncher(QRunnable):
+    '''starts the kernel process off the GUI thread, so it boots while the document loads'''
     def __init__(self, text_edit):
-        super().__init__(text_edit)
+        super().__init__()
+        self.text_edit = text_edit
+        self.kernel_manager = None
+        self.signals = KernelLauncherSignals()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            kernel_manager = self.text_edit.start_kernel()
+            # its restarter timer must live in the GUI thread
+            kernel_manager.moveToThread(self.signals.thread())
+            self.kernel_manager = kernel_manager
+            self.signals.result.emit(kernel_manager)
+        except Exception:
+            logging.getLogger('jupad').exception('kernel launch error')
+
+class KernelShutdown(QRunnable):
+    '''shuts down a swapped out kernel without blocking the GUI, its channels are stopped by the GUI thread'''
+    def __init__(self, kernel_manager, now):
+        super().__init__()
+        self.kernel_manager = kernel_manager
+        self.now = now
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            self.kernel_manager.shutdown_kernel(now=self.now)
+        except Exception:
+            logging.getLogger('jupad').exception('kernel shutdown error')
+
+class KernelPool:
+    '''spare kernels, started in the background and swapped in on restart or by new pads,
+    shared by the pads of a process, at most size of them'''
+    def __init__(self, size=1):
+        self.size = size
+        self.kernels = [] # (kernel_name, kernel_manager, kernel_client)
+
+    def full(self):
+        return len(self.kernels) >= self.size
+
+    def put(self, kernel_name, kernel_manager, kernel_client):
+        self.kernels.append((kernel_name, kernel_manager, kernel_client))
+
+    def take(self, kernel_name, thread_pool):
+        '''a spare (kernel_manager, kernel_client) of the given kernel, or None,
+        dead spares found on the way are shut down in thread_pool'''
+        for kernel in list(self.kernels):
+            if kernel[0] != kernel_name:
+                continue
+            self.kernels.remove(kernel)
+            if kernel[1].is_alive():
+                return kernel[1:]
+            kernel[2].stop_channels()
+            thread_pool.start(KernelShutdown(kernel[1], True))
+        return None
+
+    def shutdown(self):
+        for kernel_name, kernel_manager, kernel_client in self.kernels:
+            kernel_client.stop_channels()
+            kernel_manager.shutdown_kernel(now=True)
+        self.kernels = []
+
+class FileWriterSignals(QObject):
+    written = pyqtSignal(str, str) # path, text
+
+class FileWriter(QRunnable):
+    '''writes a file off the GUI thread, through a temp file renamed over it, or appends to it'''
+    def __init__(self, path, text, append=False, remove_path=None):
+        super().__init__()
+        self.path = path
+        self.text = text
+        self.append = append
+        self.remove_path = remove_path # removed once the file is written
+        self.signals = FileWriterSignals()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            if self.append:
+                with open(self.path, 'a') as f:
+                    f.write(self.text)
+                return
+            path = os.path.realpath(self.path) # keep symlinks
+            dir_path, base_name = os.path.split(path)
+            tmp_path = os.path.join(dir_path, f'.{base_name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(self.text)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp_path, os.stat(path).st_mode)
+            except OSError:
+                pass
+            # a crash leaves either the old file or the new one, never a partial one
+            os.replace(tmp_path, path)
+            if self.remove_path and os.path.exists(self.remove_path):
+                os.remove(self.remove_path)
+            self.signals.written.emit(self.path, self.text)
+        except Exception:
+            logging.getLogger('jupad').exception('file save error')
 
-    def _format_tooltip(self, doc):
-        return self._text_edit.html_converter.convert(doc)
+class StagedOutput:
+    '''outputs of one execution, kept aside until the execution is done,
+    rendered only if they differ from what the out cell already shows'''
+    def __init__(self, cell_idx):
+        self.cell_idx = cell_idx
+        self.items = []
+        self.has_image = False
+        self.live = False # rendered as they arrive, for long executions
+        self.cache_key = None # the executed code and the codes before it, for output_cache
+        self.digest = hashlib.sha1()
+
+    def add(self, key, kind, *args):
+        # key identifies the content, args are used for rendering (images are named by their msg_id)
+        key = key.encode() if isinstance(key, str) else key
+        self.digest.update(f'{kind}:{len(key)}:'.encode())
+        self.digest.update(key)
+        self.items.append((kind, args))
+
+class UndoEntry:
+    '''an edit that replaced the codes old of the cells from start on with new'''
+    def __init__(self, start, old, new, cursor_before, cursor_after):
+        self.start = start
+        self.old = old
+        self.new = new
+        self.cursor_before = cursor_before # (cell_idx, pos_in_cell)
+        self.cursor_after = cursor_after
+
+    def size(self):
+        return sum(len(code) for code in self.old) + sum(len(code) for code in self.new)
+
+class UndoHistory:
+    '''code edits for undo/redo, the oldest are dropped past max_entries or max_size (characters of code)'''
+    def __init__(self, max_entries=1000, max_size=16*1024*1024, merge_interval=1.0):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.merge_interval = merge_interval # typing in a cell without pausing is undone at once
+        self.undo_entries = deque()
+        self.redo_entries = []
+        self.size = 0
+        self.last_push = 0
+        self.can_merge = False
+
+    def push(self, entry):
+        for redo_entry in self.redo_entries:
+            self.size -= redo_entry.size()
+        self.redo_entries.clear()
+        now = time.monotonic()
+        top = self.undo_entries[-1] if self.undo_entries else None
+        if (self.can_merge and now - self.last_push < self.merge_interval and
+                len(entry.old) == len(entry.new) == len(top.new) == 1 and top.start == entry.start and top.new == entry.old):
+            self.size -= top.size()
+            top.new = entry.new
+            top.cursor_after = entry.cursor_after
+            self.size += top.size()
+        else:
+            self.undo_entries.append(entry)
+            self.size += entry.size()
+        self.last_push = now
+        self.can_merge = True
+        while len(self.undo_entries) > self.max_entries or (self.size > self.max_size and len(self.undo_entries) > 1):
+            self.size -= self.undo_entries.popleft().size()
+
+    def undo(self):
+        if not self.undo_entries:
+            return None
+        entry = self.undo_entries.pop()
+        self.redo_entries.append(entry)
+        self.can_merge = False
+        return entry
+
+    def redo(self):
+        if not self.redo_entries:
+            return None
+        entry = self.redo_entries.pop()
+        self.undo_entries.append(entry)
+        self.can_merge = False
+        return entry
+
+class HighlighterBlockData(PygmentsBlockUserData):
+    '''the column of the block, and its tokens as of the last time it was lexed'''
+    code = False
+    text = None
+    revision = None # changes with the text, for get_cell_code_cached
+    prev_syntax_stack = None
+    tokens = () # (index, length, token)
+
+block_revisions = itertools.count()
+
+class Highlighter(PygmentsHighlighter):
+    def highlightBlock(self, string):
+        block = self.currentBlock()
+        data = block.userData()
+        if data is None:
+            # a block stays in its cell, look its column up once
+            cell = self.parent().table.cellAt(block.position())
+            if not cell.isValid():
+                return # not in the table (yet), looked up again next time
+            data = HighlighterBlockData(code=cell.column() == 0)
+            block.setUserData(data)
+        if not data.code:
+            return # don't highlight output cells
+        if data.text != string:
+            data.revision = next(block_revisions)
+        if _lexpatch is None:
+            revision = data.revision
+            super().highlightBlock(string)
+            # it replaces our user data with its own, attach ours again, with the lexer state it left for the next block
+            block.setUserData(HighlighterBlockData(code=True, text=string, revision=revision,
+                                                   syntax_stack=getattr(block.userData(), 'syntax_stack', ('root',))))
+            return
+        prev_data = block.previous().userData()
+        prev_syntax_stack = prev_data.syntax_stack if prev_data is not None else ('root',)
+        # blocks are highlighted again also when only their format changed, lex only when the text did
+        if data.text != string or data.prev_syntax_stack != prev_syntax_stack:
+            tokens = []
+            with _lexpatch():
+                self._lexer._saved_state_stack = prev_syntax_stack
+                index = 0
+                for token, text in self._lexer.get_tokens(string):
+                    length = qstring_length(text)
+                    tokens.append((index, length, token))
+                    index += length
+                data.syntax_stack = tuple(self._lexer._saved_state_stack)
+                del self._lexer._saved_state_stack
+            data.text = string
+            data.prev_syntax_stack = prev_syntax_stack
+            data.tokens = tokens
+            # a changed stack (like an opened multiline string) highlights the next block as well
+            self.setCurrentBlockState(hash(data.syntax_stack) & 0x7fffffff)
+        for index, length, token in data.tokens:
+            self.setFormat(index, length, self._get_format(token))
 
 class JupadTextEdit(QTextEdit, BaseFrontendMixin):
-    def __init__(self, parent, file_path, kernel_name='python3', debug=False):
+    def __init__(self, parent, file_path, kernel_name='python3', debug=False, timeout=30, memory_limit=0, cpu_limit=0, journal=False,
+                 kernel_pool=None, input_timeout=30, cwd=None, replay_input=False):
         self.kernel_name = kernel_name
+        self.replay_input = replay_input # answer input() again with the answer it got for the same code and prompt
+        self.cwd = cwd # the kernel's working directory, pads opened by another jupad don't share its directory
+        self.input_timeout = input_timeout # seconds an input() waits for an answer before it gets an empty one
+        self.journal = journal # append edits to a journal file, recovered if jupad didn't save
+        self.execute_timeout = timeout
+        self.memory_limit = memory_limit # MB
+        self.cpu_limit = cpu_limit # seconds
+        self.limit_warned = False
         self.log = logging.getLogger('jupad')
-        self.log.setLevel(logging.DEBUG if debug else logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter('%(relativeCreated)d %(message)s'))
-        handler.setLevel(logging.DEBUG)
-        self.log.addHandler(handler)
+        # pads share the logger, debug stays on once a pad asked for it
+        self.log.setLevel(logging.DEBUG if debug or self.log.level == logging.DEBUG else logging.INFO)
+        if 'jupad' not in [handler.get_name() for handler in self.log.handlers]: # once for all pads
+            handler = logging.StreamHandler(sys.stdout)
+            handler.set_name('jupad')
+            handler.setFormatter(logging.Formatter('%(relativeCreated)d %(message)s'))
+            handler.setLevel(logging.DEBUG)
+            self.log.addHandler(handler)
         self.log.debug('start')
-        sys.excepthook = self.exception_hook
         super().__init__(parent)
 
         if QGuiApplication.styleHints().colorScheme() == Qt.ColorScheme.Dark:
@@ -148,7 +488,89 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.save_timer.setInterval(5000)
         self.save_timer.timeout.connect(self.save_file)
 
-        # so ctrl+z won't undo initialization:
+        self.journal_timer = QTimer()
+        self.journal_timer.setSingleShot(True)
+        self.journal_timer.setInterval(1000)
+        self.journal_timer.timeout.connect(self.write_journal)
+
+        # changes of the file by other programs are merged into the pad
+        self.file_watcher = QFileSystemWatcher()
+        self.file_watcher.fileChanged.connect(self.file_changed)
+        self.file_changed_timer = QTimer()
+        self.file_changed_timer.setSingleShot(True)
+        self.file_changed_timer.setInterval(200)
+        self.file_changed_timer.timeout.connect(self.reload_file)
+
+        self.live_output_timer = QTimer()
+        self.live_output_timer.setSingleShot(True)
+        self.live_output_timer.setInterval(300)
+        self.live_output_timer.timeout.connect(self.live_output)
+
+        # escalates interrupt -> interrupt -> restart for cells running longer than execute_timeout
+        self.timeout_timer = QTimer()
+        self.timeout_timer.setSingleShot(True)
+        self.timeout_timer.timeout.connect(self.execute_timed_out)
+        self.timeout_grace = 2000
+        self.timeout_stage = 0
+        self.timeout_msg_id = ''
+
+        # input() is answered in the out cell, or cancelled with an empty answer so executions keep going
+        self.input_timer = QTimer()
+        self.input_timer.setSingleShot(True)
+        self.input_timer.timeout.connect(self.cancel_input)
+
+        self.interrupt_timer = QTimer()
+        self.interrupt_timer.setSingleShot(True)
+        self.interrupt_timer.setInterval(100)
+        self.interrupt_timer.timeout.connect(self.interrupt_running)
+
+        # call tips wait for typing to pause
+        self.inspect_timer = QTimer()
+        self.inspect_timer.setSingleShot(True)
+        self.inspect_timer.setInterval(150)
+        self.inspect_timer.timeout.connect(self.inspect)
+
+        # kernel_info is requested again until iopub is connected
+        self.kernel_info_timer = QTimer()
+        self.kernel_info_timer.setSingleShot(True)
+        self.kernel_info_timer.setInterval(200)
+        self.kernel_info_timer.timeout.connect(self.request_kernel_info)
+
+        # cells past the first materialize_chunk of a large pad are kept as code only (virtual_cells),
+        # and added to the table as the view scrolls near its end
+        self.virtual_cells = []
+        self.materialize_chunk = 100
+        self.materialize_timer = QTimer()
+        self.materialize_timer.setSingleShot(True)
+        self.materialize_timer.setInterval(0)
+        self.materialize_timer.timeout.connect(self.materialize_visible)
+
+        self.kernel_memory_timer = QTimer()
+        self.kernel_memory_timer.setInterval(2000)
+        self.kernel_memory_timer.timeout.connect(self.update_title)
+
+        # spare kernels, started in the background, are swapped in on restart, pads of a process share them
+        self.own_kernel_pool = kernel_pool is None
+        self.kernel_pool = KernelPool() if kernel_pool is None else kernel_pool
+        self.spare_kernel_timer = QTimer()
+        self.spare_kernel_timer.setSingleShot(True)
+        self.spare_kernel_timer.setInterval(3000)
+        self.spare_kernel_timer.timeout.connect(self.start_spare_kernel)
+
+        self.thread_pool = QThreadPool()
+        # a single thread, so writes land in order
+        self.save_pool = QThreadPool()
+        self.save_pool.setMaxThreadCount(1)
+        self.kernel_launcher = None
+        self.spare_kernel_launcher = None
+        pooled_kernel = self.kernel_pool.take(kernel_name, self.thread_pool)
+        if pooled_kernel is None:
+            self.kernel_launcher = KernelLauncher(self)
+            self.kernel_launcher.signals.result.connect(self.kernel_launched)
+            self.log.debug('launch kernel')
+            self.thread_pool.start(self.kernel_launcher)
+
+        # undo is done by undo_history, qt's undo stack would only pile up the outputs written into the document
         self.setUndoRedoEnabled(False)
 
         font = QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont)
@@ -175,31 +597,63 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.highlighter = Highlighter(self)
         self.highlighter.set_style(self.theme['pygments_style'])
 
-        self.in_undo_redo = False
         self.execution_count = [None]
         self.has_image = [False]
+        self.out_hash = [None]
         self.latex = ['']
         self.pending_newline = ['']
+        self.truncated = [False]
         self.out_cell_cursor = [None]
+        self.code_cache = [None] # (block revisions, code)
+        self.out_key = [None] # output_cache key of the codes executed up to the cell, None if not executed yet
+        self.undo_history = UndoHistory()
+        self.edit_range = None # [start, end) of the cells touched by the edit being recorded
+        self.edit_old = [] # and their codes before it
 
         self.execute_running = False
-        self.prev_execute_msg_id = ''
         self.execute_msg_id = ''
-        self.prev_execute_cell_idx = -1
         self.execute_cell_idx = -1
+        self.output_stages = {} # msg_id -> StagedOutput
+        self.execute_code = {} # msg_id -> code, for executions the kernel hasn't finished
+        self.running_msg_id = '' # execution the kernel is running right now
+        self.interrupt_msg_ids = set() # stale executions to interrupt once they start
+        self.blocked_code = {} # code -> error shown instead of executing it, until the cell is edited
+        self.full_output_msg_id = ''
+        self.full_output_cell_idx = -1
+        self.input_msg_id = '' # execution waiting for input
+        self.input_key = None # (code, prompt)
+        self.input_password = False
+        self.input_text = ''
+        self.input_pos = -1 # of the end of the prompt in the out cell
+        self.input_answers = OrderedDict() # (code, prompt) -> answer, given again when the cell executes again (replay_input)
         self.splash_visible = False
         self.kernel_info = ''
+        self.iopub_connected = False
         self.divider_drag = False
-        self.file = None
+        self.file_path = None
+        self.saved_text = None # last text written to the file
+        self.journal_codes = None # codes as of the last journal entry
         self.setMouseTracking(True)
         self.setContextMenuPolicy(Qt.ContextMenuPolicy.NoContextMenu)
-        self.ansi_processor = QtAnsiCodeProcessor()
-        self.html_converter = Ansi2HTMLConverter(inline=True, line_wrap=False, dark_bg=self.theme['is_dark'])
+        # created on first use, keeps their imports off the startup path
+        self._ansi_processor = None
+        self._html_converter = None
         self._control = self # for CompletionWidget
-        self.completion_widget = CompletionWidget_(self, 0)
-        self.call_tip_widget = CallTipWidget_(self)
+        self._completion_widget = None
+        self._call_tip_widget = None
         self.transformer_manager = None
-        self.thread_pool = QThreadPool()
+        self.is_complete_cache = OrderedDict() # code -> (status, indent)
+        self.is_complete_cache_size = 1024
+        self.is_complete_msg_ids = {} # msg_id -> code
+        self.complete_msg_id = ''
+        self.completion_cache = None # (namespace, cell_idx, code before the completed text, start, matches)
+        self.kernel_generation = 0 # bumped when the kernel is replaced
+        self.latex_cache = LatexCache(os.path.expanduser(os.path.join('~', '.jupad', 'latex_cache')))
+        self.latex_workers = []
+        self.svg_images = OrderedDict() # resource name -> svg, to re-rasterize on resize
+        self.svg_cache = OrderedDict() # (svg hash, width) -> rasterized image
+        self.output_cache = OrderedDict() # StagedOutput.cache_key -> (items, digest), restored by undo
+        self.output_cache_size = 256
         self.executing_animation = AnimateExecutingCell(self)
 
         # for setting cells format and initialize lists:
@@ -209,6 +663,8 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.document().begin().setVisible(False) # https://stackoverflow.com/questions/76061158
 
         self.cursorPositionChanged.connect(self.position_changed)
+        self.verticalScrollBar().valueChanged.connect(self.schedule_materialize)
+        self.verticalScrollBar().rangeChanged.connect(self.schedule_materialize)
 
         self.open_file(file_path)
 
@@ -216,38 +672,183 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
             self.set_splash(True)
             self.splash_visible = True
 
+        if pooled_kernel is not None:
+            self.log.debug('kernel from pool')
+            self.swap_in_kernel(*pooled_kernel)
+            self.kernel_memory_timer.start()
         self.log.debug('show')
-        self.setReadOnly(True)
         self.parent().setCentralWidget(self)
         self.parent().show()
-        self.launch_kernel()
 
-    def launch_kernel(self):
-        self.log.debug('launch kernel')
-        kernel_manager = QtKernelManager(kernel_name=self.kernel_name)
-        extra_arguments = []
-        if self.kernel_name in ['python3', 'sagemath']: # mathics?
-            extra_arguments.append('--InteractiveShell.ast_node_interactivity=last_expr_or_assign')
-        kernel_manager.start_kernel(extra_arguments=extra_arguments)
+    @property
+    def ansi_processor(self):
+        if self._ansi_processor is None:
+            from qtconsole.ansi_code_processor import QtAnsiCodeProcessor
+            self._ansi_processor = QtAnsiCodeProcessor()
+        return self._ansi_processor
+
+    @property
+    def html_converter(self):
+        if self._html_converter is None:
+            from ansi2html import Ansi2HTMLConverter
+            self._html_converter = Ansi2HTMLConverter(inline=True, line_wrap=False, dark_bg=self.theme['is_dark'])
+        return self._html_converter
+
+    @property
+    def completion_widget(self):
+        if self._completion_widget is None:
+            from jupad.popups import CompletionWidget_
+            self._completion_widget = CompletionWidget_(self, 0)
+        return self._completion_widget
+
+    @property
+    def call_tip_widget(self):
+        if self._call_tip_widget is None:
+            from jupad.popups import CallTipWidget_
+            self._call_tip_widget = CallTipWidget_(self)
+        return self._call_tip_widget
+
+    @pyqtSlot(object)
+    def kernel_launched(self, kernel_manager):
+        if self.kernel_launcher is None:
+            return # closed meanwhile
+        self.log.debug('kernel launched')
+        self.kernel_launcher = None
+        self.swap_in_kernel(*self.connect_kernel(kernel_manager))
+        self.kernel_memory_timer.start()
+
+    def swap_in_kernel(self, kernel_manager, kernel_client):
+        # spare kernels might have been started by another pad
+        kernel_client.control_channel.message_received.connect(self._dispatch)
+        self.kernel_manager, self.kernel_client = kernel_manager, kernel_client
+        # its status messages on iopub tell us iopub is connected
+        self.iopub_connected = False
+        self.start_restarter()
+        self.limit_kernel()
+        self.set_kernel_cwd()
+        self.spare_kernel_timer.start()
+        # edits until kernel_info_reply are only queued, it executes all cells once the kernel is ready
+        self.request_kernel_info()
+
+    def start_restarter(self):
+        from jupad.kernels import ClaimedKernelManager
+        # daemon kernels aren't restarted by their manager
+        if not isinstance(self.kernel_manager, ClaimedKernelManager):
+            self.kernel_manager.autorestart = True
+            self.kernel_manager.start_restarter()
+
+    def kernel_ready(self):
+        return self.kernel_client is not None and self.iopub_connected and self.kernel_info != ''
 
+    @pyqtSlot()
+    def request_kernel_info(self):
+        self.kernel_client.kernel_info()
+
+    def start_kernel(self):
+        '''starts a kernel process, its restarter isn't started, safe to call outside the GUI thread'''
+        # jupyter_client and zmq are imported here, off the startup path
+        from jupad.kernels import ClaimedKernelManager, QtKernelManager
+        # a prewarmed kernel from the jupad daemon, if one is running
+        claimed = claim_kernel(self.kernel_name)
+        if claimed is not None:
+            self.log.debug(f'claimed daemon kernel {claimed["connection_file"]}')
+            # the daemon owns the process, we don't restart it, died kernels are handled by _handle_kernel_died
+            return ClaimedKernelManager(claimed['pid'], claimed['kernel_file'], kernel_name=self.kernel_name, connection_file=claimed['connection_file'],
+                                        client_class='jupad.kernels.JupadKernelClient', autorestart=False)
+        kernel_manager = QtKernelManager(kernel_name=self.kernel_name, client_class='jupad.kernels.JupadKernelClient', autorestart=False)
+        extra_arguments, env = kernel_launch_args(self.kernel_name)
+        kernel_manager.start_kernel(extra_arguments=extra_arguments, env=env)
+        return kernel_manager
+
+    def connect_kernel(self, kernel_manager):
         kernel_client = kernel_manager.client()
         kernel_client.start_channels()
+        return kernel_manager, kernel_client
 
-        self.kernel_manager = kernel_manager
-        self.kernel_client = kernel_client
+    @pyqtSlot()
+    def start_spare_kernel(self):
+        if self.kernel_pool.full():
+            return
+        if self.execute_running:
+            # don't compete with executions
+            self.spare_kernel_timer.start()
+            return
+        if self.spare_kernel_launcher is not None:
+            return # already starting
+        self.log.debug('start spare kernel')
+        self.spare_kernel_launcher = KernelLauncher(self)
+        self.spare_kernel_launcher.signals.result.connect(self.spare_kernel_launched)
+        self.thread_pool.start(self.spare_kernel_launcher)
+
+    @pyqtSlot(object)
+    def spare_kernel_launched(self, kernel_manager):
+        if self.spare_kernel_launcher is None:
+            return # closed meanwhile
+        self.spare_kernel_launcher = None
+        if self.kernel_pool.full():
+            # another pad filled the pool meanwhile
+            self.thread_pool.start(KernelShutdown(kernel_manager, True))
+            return
+        # channels are connected right away, so they are subscribed by the time the spare is swapped in
+        self.kernel_pool.put(self.kernel_name, *self.connect_kernel(kernel_manager))
 
-        # we finish startup upon kernel_info_reply, when kernel is ready
-        kernel_client.kernel_info()
+    def limit_kernel(self):
+        # rlimits are set on the running kernel process, so again after every restart
+        if not self.memory_limit and not self.cpu_limit:
+            return
+        if not sys.platform.startswith('linux'):
+            # prlimit sets the limits of another process, only linux has it
+            if not self.limit_warned:
+                self.log.warning('kernel memory and cpu limits are supported only on linux')
+                self.limit_warned = True
+            return
+        try:
+            import resource
+            pid = self.kernel_pid()
+            if self.memory_limit:
+                limit = self.memory_limit * 1024 * 1024
+                resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+            if self.cpu_limit:
+                resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit))
+        except Exception:
+            self.log.exception('failed to limit kernel resources')
+
+    def set_kernel_cwd(self):
+        # spare and daemon kernels were started elsewhere, queued before the cells are executed
+        if self.cwd is not None and self.kernel_name in ['python3', 'sagemath']:
+            self.ignore_msg_id(self.kernel_client.execute(f"__import__('os').chdir({self.cwd!r})", silent=True, stop_on_error=False))
+
+    def kernel_pid(self):
+        from jupad.kernels import ClaimedKernelManager
+        if isinstance(self.kernel_manager, ClaimedKernelManager):
+            return self.kernel_manager.pid
+        return getattr(self.kernel_manager and self.kernel_manager.provisioner, 'pid', None)
+
+    def kernel_memory(self):
+        '''resident memory of the kernel process in bytes, None if unknown'''
+        pid = self.kernel_pid()
+        if pid is None:
+            return None
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import psutil
+            return psutil.Process(pid).memory_info().rss
+        except Exception:
+            return None
 
-    def exception_hook(self, etype, value, tb):
-        sys.__excepthook__(etype, value, tb)
-        msg = ''.join(traceback.format_exception(etype, value, tb))
-        QMessageBox(QMessageBox.Icon.Critical, 'Exception', msg).exec()
-        try: self.log.error(msg)
-        except: pass
-        try: self.save_file()
-        except: pass
-        sys.exit(1)
+    @pyqtSlot()
+    def update_title(self):
+        title = os.path.basename(self.file_path) if self.file_path else 'jupad'
+        memory = self.kernel_memory()
+        if memory is not None:
+            title += f' - kernel {memory // (1024 * 1024)} MB'
+            if self.memory_limit:
+                title += f' / {self.memory_limit} MB'
+        self.parent().setWindowTitle(title)
 
     def set_splash(self, visible):
         if self.splash_visible == visible == False:
@@ -272,28 +873,91 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.splash_visible = visible
 
     def is_complete(self, code):
+        '''(status, indent) of the code, never waits for the kernel'''
+        if code in self.is_complete_cache:
+            self.is_complete_cache.move_to_end(code)
+            return self.is_complete_cache[code]
         if self.kernel_name in ['python3', 'sagemath']:
             if self.transformer_manager is None:
                 from IPython.core.inputtransformer2 import TransformerManager
                 self.transformer_manager = TransformerManager()
-            return self.transformer_manager.check_complete(code)
+            result = self.transformer_manager.check_complete(code)
         elif 'xcpp' in self.kernel_name:
-            # poor man's cpp is_complete
-            st = ['EOF']
-            for c in code:
-                if c in '({[':
-                    st.append(c)
-                elif ((c == ')' and st[-1] == '(') or
-                      (c == '}' and st[-1] == '{') or
-                      (c == ']' and st[-1] == '[')):
-                    st.pop()
-                elif c in ')}]':
-                    return 'invalid', None
-            if st[-1] == 'EOF':
-                return 'complete', None
+            result = self.brackets_complete(code)
+        else:
+            # until the kernel replies
+            self.request_is_complete(code)
+            return self.brackets_complete(code)
+        self.cache_is_complete(code, result)
+        return result
+
+    def cache_is_complete(self, code, result):
+        self.is_complete_cache[code] = result
+        self.is_complete_cache.move_to_end(code)
+        while len(self.is_complete_cache) > self.is_complete_cache_size:
+            self.is_complete_cache.popitem(last=False)
+
+    def request_is_complete(self, code):
+        '''ask kernels we can't check locally, the reply is cached for the next is_complete'''
+        if (self.kernel_name in ['python3', 'sagemath'] or 'xcpp' in self.kernel_name or
+                code in self.is_complete_cache or code in self.is_complete_msg_ids.values() or
+                not self.kernel_ready()):
+            return
+        self.is_complete_msg_ids[self.kernel_client.is_complete(code)] = code
+
+    @staticmethod
+    def brackets_complete(code):
+        # poor man's is_complete, by brackets
+        st = ['EOF']
+        for c in code:
+            if c in '({[':
+                st.append(c)
+            elif ((c == ')' and st[-1] == '(') or
+                  (c == '}' and st[-1] == '{') or
+                  (c == ']' and st[-1] == '[')):
+                st.pop()
+            elif c in ')}]':
+                return 'invalid', None
+        if st[-1] == 'EOF':
+            return 'complete', None
+        else:
+            last_line = code.splitlines()[-1].replace('\t', '  ')
+            return 'incomplete', len(re.match(r'^ *', last_line)[0])
+
+    def split_statements(self, lines):
+        '''group pasted lines (\\u2028 for newlines within a line) into cells of complete statements'''
+        if self.kernel_name in ['python3', 'sagemath']:
+            # a single parse, lines are cut between top level statements
+            try:
+                tree = ast.parse('\n'.join(lines).replace('\u2028', '\n'))
+            except (SyntaxError, ValueError):
+                pass # ipython syntax or incomplete code
             else:
-                last_line = code.splitlines()[-1].replace('\t', '  ')
-                return 'incomplete', len(re.match(r'^ *', last_line)[0])
+                joined = set() # line numbers followed by a line of the same statement
+                for node in tree.body:
+                    start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+                    joined.update(range(start, node.end_lineno))
+                codes = []
+                code_lines = []
+                line_number = 0
+                for line in lines:
+                    code_lines.append(line)
+                    line_number += line.count('\u2028') + 1
+                    if line_number not in joined:
+                        codes.append('\u2028'.join(code_lines))
+                        code_lines = []
+                if code_lines:
+                    codes.append('\u2028'.join(code_lines))
+                return codes
+        codes = []
+        code_lines = []
+        for i, line in enumerate(lines):
+            code_lines.append(line)
+            is_complete, indent = self.is_complete('\n'.join(code_lines).replace('\u2028', '\n'))
+            if is_complete != 'incomplete' or i == len(lines)-1: # complete or invalid or no more lines
+                codes.append('\u2028'.join(code_lines))
+                code_lines = []
+        return codes
 
     def code_cell(self, cell_idx):
         cell = self.table.cellAt(cell_idx, 0)
@@ -307,13 +971,13 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
 
     def insert_cell(self, cell_idx):
         '''insert cell before the given index'''
-        self.table.insertRows(cell_idx, 1)
-        self.execution_count.insert(cell_idx, None)
-        self.has_image.insert(cell_idx, False)
-        self.latex.insert(cell_idx, '')
-        self.pending_newline.insert(cell_idx, '')
+        self.insert_cells(cell_idx, [''])
 
-        out_cell = self.out_cell(cell_idx)
+    def insert_cells(self, cell_idx, codes):
+        '''insert cells with the given codes before the given index, the cursor ends up at the end of the last one'''
+        count = len(codes)
+        if count == 0:
+            return
         out_cell_format = QTextTableCellFormat()
         out_cell_format.setLeftBorder(3)
         out_cell_format.setLeftBorderStyle(QTextTableFormat.BorderStyle_Solid)
@@ -322,9 +986,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         out_cell_format.setBottomBorder(1)
         out_cell_format.setBottomBorderStyle(QTextTableFormat.BorderStyle_Solid)
         out_cell_format.setBottomBorderBrush(self.theme['separator_color'])
-        out_cell.setFormat(out_cell_format)
 
-        code_cell = self.code_cell(cell_idx)
         code_cell_format = QTextTableCellFormat()
         code_cell_format.setLeftBorder(3)
         code_cell_format.setLeftBorderStyle(QTextTableFormat.BorderStyle_Solid)
@@ -332,32 +994,104 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         code_cell_format.setBottomBorder(1)
         code_cell_format.setBottomBorderStyle(QTextTableFormat.BorderStyle_Solid)
         code_cell_format.setBottomBorderBrush(self.theme['separator_color'])
-        code_cell.setFormat(code_cell_format)
 
-        self.setTextCursor(code_cell.firstCursorPosition())
-        self.out_cell_cursor.insert(cell_idx, out_cell.lastCursorPosition())
+        self.touch_cells(cell_idx, cell_idx)
+        # a single edit block, so the document is laid out once for all cells
+        block_cursor = QTextCursor(self.document())
+        block_cursor.beginEditBlock()
+        try:
+            self.table.insertRows(cell_idx, count)
+            for i, code in enumerate(codes, cell_idx):
+                self.out_cell(i).setFormat(out_cell_format)
+                code_cell = self.code_cell(i)
+                code_cell.setFormat(code_cell_format)
+                if code:
+                    code_cell.firstCursorPosition().insertText(code)
+        finally:
+            block_cursor.endEditBlock()
+        if self.edit_range is not None:
+            self.edit_range[1] += count
+        if cell_idx > 0:
+            # rows added at the end of the table push the output cursor at the end of the last row into them
+            prev_cell = self.out_cell(cell_idx-1)
+            if self.out_cell_cursor[cell_idx-1].position() > prev_cell.lastCursorPosition().position():
+                self.out_cell_cursor[cell_idx-1] = prev_cell.lastCursorPosition()
+        self.splice_cell_state(cell_idx, 0, count)
+        self.setTextCursor(self.code_cell(cell_idx+count-1).lastCursorPosition())
+
+    def materialize_cells(self, count):
+        '''move cells from virtual_cells to the end of the table'''
+        codes, self.virtual_cells = self.virtual_cells[:count], self.virtual_cells[count:]
+        if not codes:
+            return
+        self.log.debug(f'materialize {len(codes)} cells, {len(self.virtual_cells)} left')
+        cursor = self.textCursor()
+        scroll = self.verticalScrollBar().value()
+        cell_idx = self.table.rows()
+        self.insert_cells(cell_idx, codes)
+        self.setTextCursor(cursor)
+        self.verticalScrollBar().setValue(scroll)
+        self.execute(cell_idx)
+
+    def schedule_materialize(self, *args):
+        if self.virtual_cells:
+            self.materialize_timer.start()
+
+    @pyqtSlot()
+    def materialize_visible(self):
+        # the growing range schedules us again, until the viewport is filled
+        scroll_bar = self.verticalScrollBar()
+        if scroll_bar.value() >= scroll_bar.maximum() - self.viewport().height():
+            self.materialize_cells(self.materialize_chunk)
+
+    def ignore_msg_id(self, msg_id):
+        # drop the kernel messages of this execution before they get to the GUI thread
+        self.kernel_client.iopub_channel.ignore(msg_id)
 
     def stop_execution(self):
         if self.execute_running:
             self.executing_animation.stop()
+            self.discard_output(self.execute_msg_id)
+            self.interrupt_execution(self.execute_msg_id)
             self.execute_msg_id = ''
+            self.execute_running = False
+            self.timeout_timer.stop()
+
+    def interrupt_execution(self, msg_id):
+        # SIGINT outside of a running cell might kill the kernel, and what we know of the kernel lags behind it,
+        # so interrupt only executions that are still running a while after they started
+        if msg_id in self.execute_code:
+            self.interrupt_msg_ids.add(msg_id)
+            if msg_id == self.running_msg_id and not self.interrupt_timer.isActive():
+                self.interrupt_timer.start()
+
+    @pyqtSlot()
+    def interrupt_running(self):
+        if self.running_msg_id in self.interrupt_msg_ids:
+            self.log.debug(f'interrupt ({self.running_msg_id.split("_")[-1]})')
             self.kernel_manager.interrupt_kernel()
 
     def remove_cells(self, cell_idx, count):
         self.stop_execution()
+        self.touch_cells(cell_idx, cell_idx+count)
         self.table.removeRows(cell_idx, count)
-        self.execution_count[cell_idx:cell_idx+count] = []
-        self.has_image[cell_idx:cell_idx+count] = []
-        self.latex[cell_idx:cell_idx+count] = []
-        self.pending_newline[cell_idx:cell_idx+count] = []
-        self.out_cell_cursor[cell_idx:cell_idx+count] = []
-
-    def sync_amount_of_cells(self):
-        self.execution_count = [None]*self.table.rows()
-        self.has_image = [False]*self.table.rows()
-        self.latex = ['']*self.table.rows()
-        self.pending_newline = ['']*self.table.rows()
-        self.out_cell_cursor = [self.out_cell(i).lastCursorPosition() for i in range(self.table.rows())]
+        if self.edit_range is not None:
+            self.edit_range[1] -= count
+        self.splice_cell_state(cell_idx, count, 0)
+
+    def splice_cell_state(self, cell_idx, count, new_count):
+        '''replace the state of count cells from cell_idx with the fresh state of new_count cells, already in the table,
+        the state of the other cells is kept, so undo/redo costs only the rows it inserts or removes'''
+        end = cell_idx + count
+        self.execution_count[cell_idx:end] = [None]*new_count
+        self.has_image[cell_idx:end] = [False]*new_count
+        self.out_hash[cell_idx:end] = [None]*new_count
+        self.latex[cell_idx:end] = ['']*new_count
+        self.pending_newline[cell_idx:end] = ['']*new_count
+        self.truncated[cell_idx:end] = [False]*new_count
+        self.out_cell_cursor[cell_idx:end] = [self.out_cell(i).lastCursorPosition() for i in range(cell_idx, cell_idx+new_count)]
+        self.code_cache[cell_idx:end] = [None]*new_count
+        self.out_key[cell_idx:end] = [None]*new_count
 
     def get_cell_code(self, cell_idx):
         cell = self.code_cell(cell_idx)
@@ -365,6 +1099,32 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         cursor.setPosition(cell.lastCursorPosition().position(), QTextCursor.KeepAnchor)
         return cursor.selection().toPlainText()
 
+    def get_cell_code_cached(self, cell_idx):
+        '''get_cell_code, extracted again only if the cell was edited since'''
+        # the highlighter gives a block a new revision whenever its text changes,
+        # blocks it hasn't seen yet (or not since they changed, inside an edit block) have none
+        cell = self.code_cell(cell_idx)
+        block = cell.firstCursorPosition().block()
+        last_block_number = cell.lastCursorPosition().blockNumber()
+        revisions = []
+        while True:
+            data = block.userData()
+            if getattr(data, 'revision', None) is None or data.text != block.text():
+                return self.get_cell_code(cell_idx)
+            revisions.append(data.revision)
+            if block.blockNumber() >= last_block_number:
+                break
+            block = block.next()
+        revisions = tuple(revisions)
+        cached = self.code_cache[cell_idx]
+        if cached is None or cached[0] != revisions:
+            cached = self.code_cache[cell_idx] = (revisions, self.get_cell_code(cell_idx))
+        return cached[1]
+
+    def get_codes(self):
+        '''codes of all cells, virtual cells included'''
+        return [self.get_cell_code_cached(i) for i in range(self.table.rows())] + self.virtual_cells
+
     def get_cell_out(self, cell_idx):
         cell = self.out_cell(cell_idx)
         cursor = cell.firstCursorPosition()
@@ -373,8 +1133,6 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
 
     @pyqtSlot()
     def position_changed(self):
-        if self.in_undo_redo:
-            return # don't corrupt undo stack
         # fix selection to be within one column in table
         cursor = self.textCursor()
         if cursor.hasSelection():
@@ -440,6 +1198,90 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         finally:
             self.edit_block_cursor.endEditBlock()
 
+    @contextmanager
+    def undoable(self, cell_idx=None):
+        '''record the code edits made in the block in undo_history, the edits are expected
+        next to the cursor (or cell_idx), and in the cells inserted or removed'''
+        cursor = self.textCursor()
+        cursor_before = self.cell_idx_and_pos_in_cell(cursor)
+        mrow, mrow_num, mcol, mcol_num = cursor.selectedTableCells()
+        rows = [mrow, mrow+mrow_num-1] if mrow_num > 0 else [cursor_before[0]]
+        if cell_idx is not None:
+            rows.append(cell_idx)
+        rows = [row for row in rows if row >= 0] or [0]
+        # the cells around them as well, like the previous cell backspace merges into
+        start = max(0, min(rows)-1)
+        if self.edit_range is not None:
+            # the outer block records them
+            self.touch_cells(start, max(rows)+2)
+            yield
+            return
+        self.edit_range = [start, start]
+        self.edit_old = []
+        self.touch_cells(start, max(rows)+2)
+        try:
+            yield
+        finally:
+            (start, end), old_codes = self.edit_range, self.edit_old
+            self.edit_range = None
+            self.edit_old = []
+            self.record_edit(start, old_codes, self.cell_codes(start, end), cursor_before)
+
+    def touch_cells(self, start, end):
+        '''extend the cells of the edit being recorded to start..end, before they are edited'''
+        if self.edit_range is None:
+            return
+        end = min(end, self.table.rows() + len(self.virtual_cells))
+        if start < self.edit_range[0]:
+            self.edit_old[:0] = self.cell_codes(start, self.edit_range[0])
+            self.edit_range[0] = start
+        if end > self.edit_range[1]:
+            self.edit_old += self.cell_codes(self.edit_range[1], end)
+            self.edit_range[1] = end
+
+    def cell_codes(self, start, end):
+        '''codes of the cells start..end, virtual cells included'''
+        rows = self.table.rows()
+        return [self.get_cell_code(i) for i in range(start, min(end, rows))] + self.virtual_cells[max(0, start-rows):max(0, end-rows)]
+
+    def record_edit(self, start, old_codes, new_codes, cursor_before):
+        '''push the edit that replaced the codes of the cells from start on'''
+        # only the cells that changed are kept
+        common = 0
+        end = min(len(old_codes), len(new_codes))
+        while common < end and old_codes[common] == new_codes[common]:
+            common += 1
+        old_end, new_end = len(old_codes), len(new_codes)
+        while old_end > common and new_end > common and old_codes[old_end-1] == new_codes[new_end-1]:
+            old_end -= 1
+            new_end -= 1
+        if old_end == new_end == common:
+            return
+        self.undo_history.push(UndoEntry(start+common, old_codes[common:old_end], new_codes[common:new_end],
+                                         cursor_before, self.cell_idx_and_pos_in_cell(self.textCursor())))
+        # the pad moved on, a cell waiting for input would hold back the executions after it
+        self.cancel_input()
+
+    def undo(self):
+        entry = self.undo_history.undo()
+        if entry is not None:
+            self.apply_edit(entry.start, entry.new, entry.old, entry.cursor_before)
+
+    def redo(self):
+        entry = self.undo_history.redo()
+        if entry is not None:
+            self.apply_edit(entry.start, entry.old, entry.new, entry.cursor_after)
+
+    def apply_edit(self, start, old, new, cursor):
+        # the cells of old are in the pad now, only they are patched
+        if self.cell_codes(start, start+len(old)) != old:
+            self.log.debug('undo history out of date, cleared')
+            self.undo_history = UndoHistory()
+            return
+        self.patch([('replace', start, start+len(old), 0, len(new))], new, cursor)
+        self.restore_outputs(start)
+        self.schedule_save()
+
     def clear_cell(self, cell_idx):
         cell = self.out_cell(cell_idx)
         cursor = cell.firstCursorPosition()
@@ -447,6 +1289,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         cursor.removeSelectedText()
         self.has_image[cell_idx] = False
         self.pending_newline[cell_idx] = ''
+        self.truncated[cell_idx] = False
         self.out_cell_cursor[cell_idx] = cursor
 
         cell_format = cell.format().toTableCellFormat()
@@ -509,7 +1352,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                 cursor.setPosition(cursor.position() + swallow, QTextCursor.KeepAnchor)
                 cursor.insertText(substring, format)
 
-    def append_img(self, cell_idx, img, format, name):
+    def append_img(self, cell_idx, image, name):
         try:
             # name should be unique to allow undo/redo
             cell = self.out_cell(cell_idx)
@@ -517,17 +1360,69 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
             # add image in new line if cell is not empty
             if cursor != cell.firstCursorPosition():
                 cursor.insertText('\n')
-            image = QImage()
-            image.loadFromData(img, format.upper())
             self.document().addResource(QTextDocument.ImageResource, QUrl(name), image)
             image_format = QTextImageFormat()
             image_format.setName(name)
             image_format.setMaximumWidth(self.table.format().columnWidthConstraints()[1])
             cursor.insertImage(image_format)
-            self.has_image[self.execute_cell_idx] = True
+            self.has_image[cell_idx] = True
         except Exception:
             self.log.exception('set image error')
 
+    def out_column_width(self):
+        table_format = self.table.format()
+        padding = 10
+        return max(1, int(self.viewport().width()*table_format.columnWidthConstraints()[1].rawValue()/100 - padding))
+
+    def rasterize_svg(self, svg, width):
+        key = (hashlib.sha256(svg).hexdigest(), width)
+        if key in self.svg_cache:
+            self.svg_cache.move_to_end(key)
+            return self.svg_cache[key]
+        from PyQt6.QtSvg import QSvgRenderer
+        renderer = QSvgRenderer(QByteArray(svg))
+        size = renderer.defaultSize()
+        if size.width() > width:
+            size = size.scaled(width, size.height(), Qt.AspectRatioMode.KeepAspectRatio)
+        dpr = self.devicePixelRatioF()
+        image = QImage(size*dpr, QImage.Format.Format_ARGB32_Premultiplied)
+        image.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(image)
+        renderer.render(painter)
+        painter.end()
+        image.setDevicePixelRatio(dpr)
+        self.svg_cache[key] = image
+        while len(self.svg_cache) > 64:
+            self.svg_cache.popitem(last=False)
+        return image
+
+    def append_svg(self, cell_idx, svg, name):
+        try:
+            cell = self.out_cell(cell_idx)
+            cursor = cell.lastCursorPosition()
+            if cursor != cell.firstCursorPosition():
+                cursor.insertText('\n')
+            image = self.rasterize_svg(svg, self.out_column_width())
+            self.document().addResource(QTextDocument.ImageResource, QUrl(name), image)
+            self.svg_images[name] = svg
+            while len(self.svg_images) > 64:
+                self.svg_images.popitem(last=False)
+            image_format = QTextImageFormat()
+            image_format.setName(name)
+            cursor.insertImage(image_format)
+            self.has_image[cell_idx] = True
+        except Exception:
+            self.log.exception('set svg error')
+
+    def rerasterize_svgs(self):
+        # plots fit the new column width without re-executing
+        if not self.svg_images:
+            return
+        width = self.out_column_width()
+        for name, svg in self.svg_images.items():
+            self.document().addResource(QTextDocument.ImageResource, QUrl(name), self.rasterize_svg(svg, width))
+        self.document().markContentsDirty(0, self.document().characterCount())
+
     def set_cell_active(self, cell_idx, active):
         cell = self.code_cell(cell_idx)
         cell_format = cell.format().toTableCellFormat()
@@ -546,61 +1441,343 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         cell_format.setToolTip(tooltip)
         cell.setFormat(cell_format)
 
-    def restart_kernel(self):
-        self.kernel_manager.restart_kernel()
-        self.execute(0)
+    def reset_execution(self):
+        # the kernel is gone along with whatever it was running
+        self.executing_animation.stop()
+        self.timeout_timer.stop()
+        for msg_id in list(self.output_stages):
+            self.discard_output(msg_id)
+        self.execute_code.clear()
+        self.interrupt_msg_ids.clear()
+        self.is_complete_msg_ids.clear()
+        self.clear_input()
+        self.kernel_generation += 1
+        self.running_msg_id = ''
+        self.execute_msg_id = ''
+        self.execute_running = False
+        self.execution_count = [None]*self.table.rows()
+        self.out_key = [None]*self.table.rows()
+
+    def restart_kernel(self, now=False):
+        if self.kernel_client is None:
+            return # still launching
+        self.reset_execution()
+        spare_kernel = self.kernel_pool.take(self.kernel_name, self.thread_pool)
+        self.kernel_manager.stop_restarter()
+        self.kernel_manager.autorestart = False
+        self.kernel_client.stop_channels()
+        self.thread_pool.start(KernelShutdown(self.kernel_manager, now))
+        if spare_kernel is None:
+            # no spare, launch one like on startup, cells wait as they do there
+            self.log.debug('launch kernel')
+            self.kernel_manager, self.kernel_client = None, None
+            self.kernel_launcher = KernelLauncher(self)
+            self.kernel_launcher.signals.result.connect(self.kernel_launched)
+            self.thread_pool.start(self.kernel_launcher)
+            return
+        self.log.debug('swap in spare kernel')
+        # execution resumes from the first cell upon kernel_info_reply
+        self.swap_in_kernel(*spare_kernel)
+
+    def block_code(self, msg_id, error):
+        if msg_id in self.execute_code:
+            self.blocked_code[self.execute_code[msg_id]] = error
+
+    def running_or_current_msg_id(self):
+        # the cell might wait behind a stale execution, the running one is to blame
+        return self.running_msg_id or self.execute_msg_id
+
+    @pyqtSlot()
+    def execute_timed_out(self):
+        self.timeout_stage += 1
+        if self.timeout_stage == 1:
+            self.timeout_msg_id = self.running_or_current_msg_id()
+        elif self.timeout_msg_id not in self.execute_code:
+            return # the interrupt worked, it is done
+        if self.timeout_stage <= 2:
+            self.log.debug(f'timeout ({self.timeout_msg_id.split("_")[-1]}): interrupt')
+            self.kernel_manager.interrupt_kernel()
+            self.timeout_timer.start(self.timeout_grace)
+        else:
+            self.log.debug(f'timeout ({self.timeout_msg_id.split("_")[-1]}): restart')
+            self.block_code(self.timeout_msg_id, f'TimeoutError: running over {self.execute_timeout:g}s and ignoring interrupts, '
+                                                 'kernel restarted, edit the cell to run it again')
+            self.restart_kernel(now=True)
+
+    def execute_next(self, cell_idx):
+        if cell_idx+1 < self.table.rows():
+            self._execute(cell_idx+1)
+        else:
+            self.execute_running = False
+            self.timeout_timer.stop()
+            self.prune_kernel_history()
+
+    def prev_out_key(self, cell_idx):
+        '''out_key of the codes executed before the cell'''
+        return self.out_key[cell_idx-1] if cell_idx > 0 else hash(self.kernel_generation)
 
     def _execute(self, cell_idx, code=None):
         if code is None:
             code = self.get_cell_code(cell_idx)
-        with self.join_edit_block():
-            self.clear_cell(cell_idx)
-
-        self.latex[cell_idx] = ''
+        # cells execute in order, the key of the previous one is at hand
+        prev_key = self.prev_out_key(cell_idx)
+        self.out_key[cell_idx] = hash((prev_key, code)) if prev_key is not None else None
+        if code in self.blocked_code:
+            self.log.debug(f'blocked [{cell_idx}]')
+            stage = StagedOutput(cell_idx)
+            stage.add('blocked', 'text', self.blocked_code[code])
+            self.output_stages['blocked'] = stage
+            self.commit_output('blocked')
+            self.execution_count[cell_idx] = None
+            with self.join_edit_block():
+                self.set_cell_color(cell_idx, self.theme['error_color'])
+            self.execute_next(cell_idx)
+            return
         # set '_', '__', '___' to hold the previous cells output:
         prep_code = ''
         for i, var_name in ((cell_idx-1, '_'), (cell_idx-2, '__'), (cell_idx-3, '___')):
             if i >= 0 and self.execution_count[i] is not None:
                 prep_code += f'{var_name} = Out.get({self.execution_count[i]}, None)\n'
-        self.kernel_client.execute(prep_code, silent=True, stop_on_error=False)
+        self.ignore_msg_id(self.kernel_client.execute(prep_code, silent=True, stop_on_error=False))
         # don't stop on error, we interrupt kernel and execute a new cell immediately after, otherwise might get aborted
 
-        self.ansi_processor.reset_sgr()
-        self.prev_execute_cell_idx = self.execute_cell_idx
-        self.prev_execute_msg_id = self.execute_msg_id
         self.execute_cell_idx = cell_idx
         self.execute_msg_id = self.kernel_client.execute(code, stop_on_error=False)
+        self.execute_code[self.execute_msg_id] = code
+        self.output_stages[self.execute_msg_id] = StagedOutput(cell_idx)
+        self.output_stages[self.execute_msg_id].cache_key = self.out_key[cell_idx]
+        self.live_output_timer.start()
+        if self.execute_timeout > 0:
+            self.timeout_stage = 0
+            self.timeout_timer.start(int(self.execute_timeout*1000))
         self.executing_animation.start()
         self.log.debug(f'execute [{cell_idx}] ({self.execute_msg_id.split("_")[-1]}): {code}')
 
     def execute(self, cell_idx, code=None):
+        if not self.kernel_ready():
+            return # all cells are executed upon kernel_info_reply
         if self.execute_running:
             if self.execute_cell_idx < cell_idx:
                 return # eventually we will execute this cell
             else:
                 self.log.debug('interrupt kernel: new code')
-                self.kernel_manager.interrupt_kernel()
+                self.discard_output(self.execute_msg_id)
+                self.interrupt_execution(self.execute_msg_id)
         self.execute_running = True
-        self._execute(cell_idx, code)
         with self.join_edit_block():
             for i in range(cell_idx+1, self.table.rows()):
                 self.set_cell_color(i, self.theme['pending_color'])
+        self._execute(cell_idx, code)
+
+    def render_output(self, cell_idx, kind, *args):
+        if kind == 'text':
+            self.append_text(cell_idx, *args)
+        elif kind == 'image':
+            self.append_img(cell_idx, *args)
+        elif kind == 'svg':
+            self.append_svg(cell_idx, *args)
+        elif kind == 'tooltip':
+            self.set_cell_tooltip(cell_idx, *args)
+        elif kind == 'truncated':
+            self.truncated[cell_idx] = True
+        elif kind == 'latex':
+            self.latex[cell_idx] = args[0]
+            self.render_latex(cell_idx, args[0])
+
+    def render_outputs(self, cell_idx, items):
+        self.ansi_processor.reset_sgr()
+        self.clear_cell(cell_idx)
+        self.latex[cell_idx] = ''
+        self.cancel_stale_latex_workers()
+        for kind, args in items:
+            self.render_output(cell_idx, kind, *args)
+
+    def add_output(self, msg_id, key, kind, *args):
+        stage = self.output_stages.get(msg_id)
+        if stage is None:
+            return
+        if kind in ['image', 'svg']:
+            stage.has_image = True
+        stage.add(key, kind, *args)
+        if stage.live and stage.cell_idx < self.table.rows():
+            waiting_input = msg_id == self.input_msg_id and self.input_pos >= 0
+            with self.join_edit_block():
+                if waiting_input:
+                    self.render_input('') # output printed while waiting goes before the answer
+                self.render_output(stage.cell_idx, kind, *args)
+                if waiting_input:
+                    self.anchor_input()
+                    self.render_input(self.input_display())
+
+    @pyqtSlot()
+    def live_output(self):
+        # execution takes a while, show its output as it comes
+        stage = self.output_stages.get(self.execute_msg_id)
+        if stage is not None and not stage.live:
+            stage.live = True
+            self.out_hash[stage.cell_idx] = None
+            with self.join_edit_block():
+                self.render_outputs(stage.cell_idx, stage.items)
+
+    def commit_output(self, msg_id):
+        stage = self.output_stages.pop(msg_id, None)
+        if stage is None or stage.cell_idx >= self.table.rows():
+            return
+        digest = stage.digest.hexdigest()
+        if not stage.live and digest != self.out_hash[stage.cell_idx]:
+            with self.join_edit_block():
+                self.render_outputs(stage.cell_idx, stage.items)
+        self.out_hash[stage.cell_idx] = digest
+        if stage.cache_key is not None:
+            self.output_cache[stage.cache_key] = (stage.items, digest)
+            self.output_cache.move_to_end(stage.cache_key)
+            while len(self.output_cache) > self.output_cache_size:
+                self.output_cache.popitem(last=False)
+
+    def restore_outputs(self, cell_idx):
+        '''show the outputs the cells had for their current codes, if cached, before the kernel gets to them'''
+        # the cells before the one executing have their keys, the others get them as they execute
+        start = min(cell_idx, self.execute_cell_idx) if self.execute_running else cell_idx
+        key = self.prev_out_key(start)
+        if key is None:
+            return
+        with self.join_edit_block():
+            for i in range(start, self.table.rows()):
+                key = hash((key, self.get_cell_code_cached(i)))
+                if i < cell_idx:
+                    continue
+                cached = self.output_cache.get(key)
+                if cached is None:
+                    break # the cells after weren't executed after these codes either
+                if cached[1] != self.out_hash[i]:
+                    self.render_outputs(i, cached[0])
+                    self.out_hash[i] = cached[1]
+
+    def discard_output(self, msg_id):
+        if msg_id == self.input_msg_id:
+            self.clear_input() # interrupted, no answer needed
+        stage = self.output_stages.pop(msg_id, None)
+        if stage is not None and stage.live and stage.cell_idx < self.table.rows():
+            self.out_hash[stage.cell_idx] = None # partially rendered
+        self.ignore_msg_id(msg_id)
+
+    def prune_kernel_history(self):
+        # Out is only needed for '_', '__', '___', free outputs of previous executions
+        if self.kernel_name in ['python3', 'sagemath']:
+            keep = sorted(set(n for n in self.execution_count if n is not None))
+            self.ignore_msg_id(self.kernel_client.execute(f"__import__('jupad_kernel').prune_history({keep})", silent=True, stop_on_error=False))
+
+    def request_full_output(self, cell_idx):
+        # outputs are truncated by the jupad_kernel extension, ask it for the full one
+        if not self.truncated[cell_idx] or self.execution_count[cell_idx] is None:
+            return
+        self.full_output_cell_idx = cell_idx
+        self.full_output_msg_id = self.kernel_client.execute(
+            f"__import__('jupad_kernel').publish_full({self.execution_count[cell_idx]})", silent=True, stop_on_error=False)
+        self.log.debug(f'full output [{cell_idx}] ({self.full_output_msg_id.split("_")[-1]})')
+
+    def kernel_request(self, msg_type, **content):
+        '''send a complete/inspect request, ipython kernels get it on the control channel,
+        where it isn't queued behind the executions'''
+        if self.kernel_name in ['python3', 'sagemath']:
+            msg = self.kernel_client.session.msg(msg_type, content)
+            self.kernel_client.control_channel.send(msg)
+            return msg['header']['msg_id']
+        return getattr(self.kernel_client, msg_type[:-len('_request')])(**content)
+
+    def completion_namespace(self, cell_idx):
+        # completions depend on what the other cells defined
+        codes = self.get_codes()
+        return self.kernel_generation, hash(tuple(codes[:cell_idx] + codes[cell_idx+1:]))
+
+    def cached_completion(self, cell_idx, code, pos_in_cell):
+        '''(start, matches) from the last completion, filtered by what was typed since, or None'''
+        if self.completion_cache is None:
+            return None
+        namespace, cache_cell_idx, code_before, start, matches = self.completion_cache
+        typed = code[start:pos_in_cell]
+        if (cache_cell_idx != cell_idx or not code.startswith(code_before) or len(code_before) != start or
+                not re.fullmatch(r'[\w.]*', typed) or namespace != self.completion_namespace(cell_idx)):
+            return None
+        return start, [match for match in matches if match.startswith(typed)]
+
+    def request_completion(self):
+        cursor = self.textCursor()
+        self.complete_cell_idx, self.complete_pos_in_cell = self.cell_idx_and_pos_in_cell(cursor)
+        self.complete_code = self.get_cell_code(self.complete_cell_idx)
+        cached = self.cached_completion(self.complete_cell_idx, self.complete_code, self.complete_pos_in_cell)
+        if cached is not None:
+            self.log.debug(f'complete [{self.complete_cell_idx}] from cache')
+            self.complete_msg_id = ''
+            self.show_completion(*cached)
+            return
+        self.complete_msg_id = self.kernel_request('complete_request', code=self.complete_code, cursor_pos=self.complete_pos_in_cell)
 
+    def show_completion(self, start, matches):
+        cell_position = self.code_cell(self.complete_cell_idx).firstCursorPosition().position()
+        cursor = self.textCursor()
+        cursor.setPosition(cell_position + start)
+        cursor.setPosition(cell_position + self.complete_pos_in_cell, QTextCursor.KeepAnchor)
+        self.completion_widget.cancel_completion()
+        with self.undoable(self.complete_cell_idx):
+            if len(matches) == 1:
+                cursor.insertText(matches[0])
+                self.execute(self.complete_cell_idx)
+            elif len(matches) > 1:
+                prefix = os.path.commonprefix(matches)
+                if prefix:
+                    cursor.insertText(prefix)
+                else:
+                    cursor.setPosition(cursor.anchor())
+                self.completion_widget.show_items(cursor, matches, prefix_length=len(prefix))
+
+    @pyqtSlot()
     def inspect(self):
+        self.inspect_timer.stop()
+        if not self.kernel_ready():
+            return
         cursor = self.textCursor()
         self.inspect_cell_idx, self.inspect_pos_in_cell = self.cell_idx_and_pos_in_cell(cursor)
         if self.inspect_cell_idx >= 0:
             self.inspect_code = self.get_cell_code(self.inspect_cell_idx)
-            self.inspect_msg_id = self.kernel_client.inspect(self.inspect_code, self.inspect_pos_in_cell)
+            self.inspect_msg_id = self.kernel_request('inspect_request', code=self.inspect_code, cursor_pos=self.inspect_pos_in_cell, detail_level=0)
             self.log.debug(f'inspect [{self.inspect_cell_idx}] ({self.inspect_msg_id.split("_")[-1]}): {self.inspect_code}')
 
+    def render_latex(self, cell_idx, latex):
+        self.cancel_stale_latex_workers()
+        color = 'White' if self.theme['is_dark'] else 'Black'
+        scale = self.font().pixelSize() / 16
+        image_data = self.latex_cache.get_from_memory(self.latex_cache.key(latex, color, scale))
+        if image_data is not None:
+            self.set_cell_latex_img(cell_idx, latex, image_data)
+            return
+        latex_worker = LatexWorker(cell_idx, latex, self.latex_cache, color, scale)
+        latex_worker.signals.result.connect(self.set_cell_latex_img)
+        self.latex_workers.append(latex_worker)
+        self.thread_pool.start(latex_worker)
+
+    def cancel_stale_latex_workers(self):
+        # typing queues renders of intermediate expressions, drop those not started yet
+        for latex_worker in self.latex_workers:
+            if latex_worker.done:
+                continue
+            cell_idx = latex_worker.cell_idx
+            if cell_idx >= len(self.latex) or self.latex[cell_idx] != latex_worker.latex:
+                latex_worker.cancelled = True
+                try:
+                    self.thread_pool.tryTake(latex_worker)
+                except RuntimeError:
+                    pass # already finished and deleted by the pool
+        self.latex_workers = [w for w in self.latex_workers if not (w.done or w.cancelled)]
+
     @pyqtSlot(int, str, bytes)
     def set_cell_latex_img(self, cell_idx, latex, img):
         try:
             if self.latex[cell_idx] == latex:
+                self.out_hash[cell_idx] = None # no longer what its outputs render to
                 with self.join_edit_block():
                     self.clear_cell(cell_idx)
-                    self.append_img(cell_idx, img, 'PNG', latex)
+                    self.append_img(cell_idx, QImage.fromData(img, 'PNG'), latex)
         except IndexError:
             pass
 
@@ -615,46 +1792,53 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self._handle_execute_result_or_display_data( msg['content'], msg_id)
 
     def _handle_execute_result_or_display_data(self, content, msg_id):
-        if msg_id == self.execute_msg_id:
-            cell_idx = self.execute_cell_idx
-        elif msg_id == self.prev_execute_msg_id and self.prev_execute_cell_idx != self.execute_cell_idx:
-            # execute_reply and execute_results are using different sockets, and their order is not guaranteed
-            cell_idx = self.prev_execute_cell_idx
-        else:
+        if msg_id == self.full_output_msg_id and self.full_output_cell_idx < self.table.rows():
+            # full output is rendered directly, replacing the truncated one
+            cell_idx = self.full_output_cell_idx
+            self.full_output_msg_id = ''
+            self.output_stages[msg_id] = StagedOutput(cell_idx)
+            self.output_stages[msg_id].live = True
+            self.out_hash[cell_idx] = None
+            with self.join_edit_block():
+                self.clear_cell(cell_idx)
+        elif msg_id not in self.output_stages:
             return
 
-        with self.join_edit_block():
-            data = content['data']
-            if 'image/png' in data:
-                image_data = b64decode(data['image/png'].encode('ascii'))
-                self.append_img(cell_idx, image_data, 'PNG', msg_id)
-            elif 'image/jpeg' in data:
-                image_data = b64decode(data['image/jpeg'].encode('ascii'))
-                self.append_img(cell_idx, image_data, 'JPG', msg_id)
-            elif 'text/plain' in data:
-                if not self.has_image[cell_idx]:
-                    self.append_text(cell_idx, data['text/plain'])
-            else:
-                self.log.error(f'unsupported type {data}')
+        data = content['data']
+        truncated = content.get('metadata', {}).get('jupad', {}).get('truncated')
+        if truncated:
+            self.add_output(msg_id, '', 'truncated')
+            tooltip = f'{", ".join(truncated)} truncated, double click to show full output'
+            self.add_output(msg_id, tooltip, 'tooltip', tooltip)
+        if 'image/svg+xml' in data:
+            self.add_output(msg_id, data['image/svg+xml'], 'svg', data['image/svg+xml'].encode(), msg_id)
+        elif 'jupad_image' in content:
+            # decoded by JupadIOPubChannel
+            key = data['image/png'] if 'image/png' in data else data['image/jpeg']
+            self.add_output(msg_id, key, 'image', content['jupad_image'], msg_id)
+        elif 'text/plain' in data:
+            if not self.output_stages[msg_id].has_image:
+                self.add_output(msg_id, data['text/plain'], 'text', data['text/plain'])
+        else:
+            self.log.error(f'unsupported type {data}')
 
-            if 'text/latex' in data:
-                self.latex[cell_idx] = data['text/latex']
-                latex_worker = LatexWorker(cell_idx, data['text/latex'])
-                latex_worker.signals.result.connect(self.set_cell_latex_img)
-                self.thread_pool.start(latex_worker)
+        if 'text/latex' in data:
+            self.add_output(msg_id, data['text/latex'], 'latex', data['text/latex'])
 
     def _handle_error(self, msg):
         msg_id = msg['parent_header']['msg_id']
         content = msg['content']
         ename_value = content['ename'] + ': ' + content['evalue']
         self.log.debug(f'error ({msg_id.split("_")[-1]}): {ename_value}')
-        if msg_id != self.execute_msg_id:
+        if msg_id not in self.output_stages:
             return
-        self.executing_animation.stop()
-        with self.join_edit_block():
-            self.set_cell_color(self.execute_cell_idx, self.theme['error_color'])
-            self.set_cell_tooltip(self.execute_cell_idx, self.html_converter.convert(''.join(content['traceback'])))
-            self.append_text(self.execute_cell_idx, ename_value)
+        if msg_id == self.execute_msg_id:
+            self.executing_animation.stop()
+            with self.join_edit_block():
+                self.set_cell_color(self.execute_cell_idx, self.theme['error_color'])
+        traceback = ''.join(content['traceback'])
+        self.add_output(msg_id, traceback, 'tooltip', self.html_converter.convert(traceback))
+        self.add_output(msg_id, ename_value, 'text', ename_value)
 
     def _handle_execute_reply(self, msg):
         msg_id = msg['parent_header']['msg_id']
@@ -672,52 +1856,44 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                 self.set_cell_color(self.execute_cell_idx, self.theme['done_color'])
             else:
                 self.set_cell_color(self.execute_cell_idx, self.theme['error_color'])
-        if self.execute_cell_idx+1 < self.table.rows():
-            self._execute(self.execute_cell_idx+1)
-        else:
-            self.execute_running = False
+        self.execute_next(self.execute_cell_idx)
 
     def _handle_complete_reply(self, msg):
-        # code from qtconsole:
         msg_id = msg['parent_header']['msg_id']
         self.log.debug(f'complete_reply ({msg_id.split("_")[-1]})')
+        if msg_id != self.complete_msg_id:
+            return
+        content = msg['content']
+        if content.get('status', 'ok') != 'ok':
+            return
+        start = max(content['cursor_start'], 0)
+        if not content['matches']:
+            return # nothing to narrow down, the name might be defined by a cell still running
+        self.completion_cache = (self.completion_namespace(self.complete_cell_idx), self.complete_cell_idx,
+                                 self.complete_code[:start], start, content['matches'])
+        # the cursor might have moved on meanwhile, still typing the same name is fine
         cursor = self.textCursor()
-        if  (msg_id == self.complete_msg_id and
-             self.cell_idx_and_pos_in_cell(cursor) == (self.complete_cell_idx, self.complete_pos_in_cell) and
-             self.get_cell_code(self.complete_cell_idx) == self.complete_code):
-
-            content = msg['content']
-            matches = content['matches']
-            start = content['cursor_start']
-            end = content['cursor_end']
-
-            start = max(start, 0)
-            end = max(end, start)
-
-            # Move the control's cursor to the desired end point
-            cursor_pos_in_cell = self.complete_pos_in_cell
-            if end < cursor_pos_in_cell:
-                cursor.movePosition(QTextCursor.Left, n=(cursor_pos_in_cell - end))
-            elif end > cursor_pos_in_cell:
-                cursor.movePosition(QTextCursor.Right, n=(end - cursor_pos_in_cell))
-            self.setTextCursor(cursor)
-            offset = end - start
-            # Move the local cursor object to the start of the match and complete
-            cursor.movePosition(QTextCursor.Left, n=offset)
-            self.completion_widget.cancel_completion()
-
-            if len(matches) == 1:
-                cursor.setPosition(self.textCursor().position(), QTextCursor.KeepAnchor)
-                cursor.insertText(matches[0])
-                self.execute(self.complete_cell_idx)
-            elif len(matches) > 1:
-                current_pos = self.textCursor().position()
-                prefix = os.path.commonprefix(matches)
-                if prefix:
-                    cursor.setPosition(current_pos, QTextCursor.KeepAnchor)
-                    cursor.insertText(prefix)
-                    current_pos = cursor.position()
-                self.completion_widget.show_items(cursor, matches, prefix_length=len(prefix))
+        cell_idx, pos_in_cell = self.cell_idx_and_pos_in_cell(cursor)
+        if cell_idx != self.complete_cell_idx or pos_in_cell < start:
+            return
+        self.complete_code = self.get_cell_code(cell_idx)
+        self.complete_pos_in_cell = pos_in_cell
+        cached = self.cached_completion(cell_idx, self.complete_code, pos_in_cell)
+        if cached is not None:
+            self.show_completion(*cached)
+
+    def _handle_is_complete_reply(self, msg):
+        code = self.is_complete_msg_ids.pop(msg['parent_header']['msg_id'], None)
+        if code is None:
+            return
+        content = msg['content']
+        status = content.get('status')
+        if status == 'incomplete':
+            self.cache_is_complete(code, (status, len(content.get('indent', ''))))
+        elif status in ['complete', 'invalid']:
+            self.cache_is_complete(code, (status, None))
+        else: # 'unknown'
+            self.cache_is_complete(code, self.brackets_complete(code))
 
     def _handle_inspect_reply(self, msg):
         msg_id = msg['parent_header']['msg_id']
@@ -733,6 +1909,10 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
     def _handle_kernel_info_reply(self, msg):
         self.log.debug(f'kernel_info_reply')
         language_info = msg['content']['language_info']
+        if not self.iopub_connected:
+            # executing before iopub is subscribed might lose outputs (or all iopub messages with ipykernel 7)
+            self.kernel_info_timer.start()
+            return
         self.kernel_info = language_info['name'] + ' ' + language_info['version']
 
         if self.splash_visible:
@@ -742,55 +1922,172 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.recalculate_columns()
         self.execute(0)
 
-        self.setUndoRedoEnabled(True)
-        self.setReadOnly(False)
+    def _handle_execute_input(self, msg):
+        msg_id = msg['parent_header'].get('msg_id')
+        self.log.debug(f'execute_input ({msg_id.split("_")[-1]})')
+        self.running_msg_id = msg_id
+        if msg_id in self.interrupt_msg_ids:
+            self.interrupt_timer.start()
 
     def _handle_clear_output(self, msg):
         self.log.debug(f'clear_output')
 
     def _handle_input_request(self, msg):
-        self.log.debug(f'input_request')
+        msg_id = msg['parent_header'].get('msg_id')
+        content = msg['content']
+        self.log.debug(f'input_request ({msg_id.split("_")[-1]}): {content.get("prompt")}')
+        if msg_id != self.execute_msg_id:
+            self.kernel_client.input('') # stale, it is interrupted anyway
+            return
+        prompt = content.get('prompt', '')
+        self.add_output(msg_id, prompt, 'text', prompt)
+        self.input_msg_id = msg_id
+        self.input_key = (self.execute_code.get(msg_id), prompt)
+        self.input_password = content.get('password', False)
+        self.input_text = ''
+        if self.replay_input and self.input_key in self.input_answers:
+            self.input_answers.move_to_end(self.input_key)
+            self.submit_input(self.input_answers[self.input_key], replayed=True)
+            return
+        # waiting for the user isn't running over time
+        self.timeout_timer.stop()
+        if self.input_timeout > 0:
+            self.input_timer.start(int(self.input_timeout*1000))
+        self.live_output() # show the prompt now
+        self.anchor_input()
+
+    def anchor_input(self):
+        # the answer is typed at the end of the out cell
+        cell = self.out_cell(self.execute_cell_idx)
+        self.input_pos = cell.lastCursorPosition().position() - cell.firstCursorPosition().position()
+
+    def input_display(self):
+        return '•'*len(self.input_text) if self.input_password else self.input_text
+
+    def render_input(self, text):
+        cell = self.out_cell(self.execute_cell_idx)
+        cursor = cell.lastCursorPosition()
+        cursor.setPosition(cell.firstCursorPosition().position() + self.input_pos, QTextCursor.KeepAnchor)
+        with self.join_edit_block():
+            cursor.insertText(text)
+
+    def input_key_press(self, e):
+        if e.key() in [Qt.Key_Return, Qt.Key_Enter]:
+            self.submit_input(self.input_text)
+            return
+        if e.key() == Qt.Key_Backspace:
+            self.input_text = self.input_text[:-1]
+        elif e.text() and e.text().isprintable():
+            self.input_text += e.text()
+        self.render_input(self.input_display())
+        self.setTextCursor(self.out_cell(self.execute_cell_idx).lastCursorPosition())
+
+    def submit_input(self, text, remember=True, replayed=False):
+        msg_id, key, password = self.input_msg_id, self.input_key, self.input_password
+        if self.input_pos >= 0:
+            self.render_input('') # the answer is added to the output instead
+        self.clear_input()
+        self.log.debug(f'input ({msg_id.split("_")[-1]})')
+        self.kernel_client.input(text)
+        note = ' (previous answer)' if replayed else ''
+        self.add_output(msg_id, text + note + '\n', 'text', ('•'*len(text) if password else text) + note + '\n')
+        if remember and self.replay_input and not password:
+            self.input_answers[key] = text
+            while len(self.input_answers) > 64:
+                self.input_answers.popitem(last=False)
+        if self.execute_timeout > 0:
+            self.timeout_stage = 0
+            self.timeout_timer.start(int(self.execute_timeout*1000))
+
+    @pyqtSlot()
+    def cancel_input(self):
+        if self.input_msg_id:
+            self.log.debug('input cancelled')
+            self.submit_input('', remember=False)
+
+    def clear_input(self):
+        self.input_timer.stop()
+        self.input_msg_id = ''
+        self.input_key = None
+        self.input_text = ''
+        self.input_pos = -1
 
     def _handle_shutdown_reply(self, msg):
         self.log.debug(f'shutdown_reply')
 
     def _handle_status(self, msg):
         # self.kernel_status = msg['content']['execution_state']
-        return
+        self.iopub_connected = True
+        if msg['content']['execution_state'] == 'idle':
+            msg_id = msg['parent_header'].get('msg_id')
+            if msg_id == self.running_msg_id:
+                self.running_msg_id = ''
+            self.execute_code.pop(msg_id, None)
+            self.interrupt_msg_ids.discard(msg_id)
+            # all outputs of the execution arrived (iopub is ordered, unlike execute_reply on shell)
+            self.commit_output(msg_id)
 
     def _handle_stream(self, msg):
         msg_id = msg['parent_header'].get('msg_id', 'NO_MSG_ID')
-        if msg_id != self.execute_msg_id:
-            return
-        with self.join_edit_block():
-            self.append_text(self.execute_cell_idx, msg['content']['text'])
+        self.add_output(msg_id, msg['content']['text'], 'text', msg['content']['text'])
 
     def _handle_kernel_restarted(self, died=True):
+        # the kernel manager restarts a kernel that died, e.g. on hitting its limits
         self.log.debug(f'kernel_restarted')
+        self.block_died_code()
+        self.reset_execution()
+        self.limit_kernel()
+        self.set_kernel_cwd()
+        self.iopub_connected = False
+        self.request_kernel_info()
 
     def _handle_kernel_died(self, since_last_heartbeat):
         self.log.debug(f'kernel_died {since_last_heartbeat}')
+        from jupad.kernels import ClaimedKernelManager
+        # daemon kernels aren't restarted by their manager
+        if isinstance(self.kernel_manager, ClaimedKernelManager) and not self.kernel_manager.is_alive():
+            self.block_died_code()
+            self.restart_kernel(now=True)
+
+    def block_died_code(self):
+        limits = []
+        if self.memory_limit:
+            limits.append(f'{self.memory_limit} MB memory')
+        if self.cpu_limit:
+            limits.append(f'{self.cpu_limit}s CPU')
+        error = 'KernelDied: kernel died'
+        if limits:
+            error += f' (limits: {", ".join(limits)})'
+        self.block_code(self.running_or_current_msg_id(), error + ', kernel restarted, edit the cell to run it again')
 
     def keyPressEvent(self, e):
         # self.log.debug(f'keyPress {Qt.Key(e.key()).name} {Qt.KeyboardModifier(e.modifiers()).name} {e.text()}')
         cursor = self.textCursor()
         # operations that always propegate:
         if e.key() in [Qt.Key_Z, Qt.Key_Y] and (e.modifiers() & Qt.ControlModifier):
-            self.in_undo_redo = True
-            # undo/redo might change the amount of cells
-            self.stop_execution()
-            super().keyPressEvent(e)
-            self.sync_amount_of_cells()
-            self.in_undo_redo = False
-            # don't restart execute, usually undo/redo handles the output as well
+            # outputs aren't part of the undo history, they are restored from output_cache or executed again
+            if e.key() == Qt.Key_Y or (e.modifiers() & Qt.ShiftModifier):
+                self.redo()
+            else:
+                self.undo()
             return
         elif e.key() == Qt.Key_V and (e.modifiers() & Qt.ControlModifier):
             if (e.modifiers() & Qt.ShiftModifier):
-                return cursor.insertText(QApplication.clipboard().text())
+                # into the current cell, new lines included
+                cell = self.table.cellAt(cursor)
+                mrow, mrow_num, mcol, mcol_num = cursor.selectedTableCells()
+                if not cell.isValid() or cell.column() == 1 or mrow_num > 1 or mcol_num > 1:
+                    return
+                with self.edit_block(), self.undoable():
+                    cursor.insertText(QApplication.clipboard().text())
+                self.execute(cell.row())
+                self.schedule_save()
+                return
             return super().keyPressEvent(e) # paste handled by insertFromMimeData
         elif e.key() == Qt.Key_V and (e.modifiers() & Qt.ControlModifier):
             return super().keyPressEvent(e) # paste handled by insertFromMimeData
         elif e.key() == Qt.Key_R and (e.modifiers() & Qt.ControlModifier):
+            self.blocked_code.clear()
             self.restart_kernel()
             return
         elif e.key() == Qt.Key_O and (e.modifiers() & Qt.ControlModifier):
@@ -804,6 +2101,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
             return
         elif e.key() == Qt.Key_Escape:
             # escape key gives e.text()='\x1b', ignore it
+            self.cancel_input()
             return
 
         if e.key() == Qt.Key_C and (e.modifiers() & Qt.ControlModifier):
@@ -814,6 +2112,8 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                 pass
             return
         elif e.key() == Qt.Key_A and (e.modifiers() & Qt.ControlModifier):
+            # all code, virtual cells included
+            self.materialize_cells(len(self.virtual_cells))
             cursor = self.code_cell(0).firstCursorPosition()
             cursor.setPosition(self.code_cell(self.table.rows()-1).lastCursorPosition().position(), QTextCursor.KeepAnchor)
             self.setTextCursor(cursor)
@@ -845,11 +2145,13 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                     self.setTextCursor(cursor)
                 return
             return super().keyPressEvent(e)
+        if col == 1 and not cursor.hasSelection() and self.input_msg_id and cell_idx == self.execute_cell_idx:
+            return self.input_key_press(e)
         if col == 1 or mcol_num > 1:
             return
         if e.key() == Qt.Key_Space and (e.modifiers() & Qt.ControlModifier):
             return self.inspect()
-        with self.edit_block():
+        with self.edit_block(), self.undoable():
             # if multiple cells selected, start with deleting them
             if mrow_num > 1 and e.key() == Qt.Key_X and (e.modifiers() & Qt.ControlModifier):
                 # cut is not working properly when multiple cells selected
@@ -858,11 +2160,13 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                 self.remove_cells(mrow+1, mrow_num)
                 if mrow == 0:
                     self.execute(0) # to show splash
+                self.schedule_save()
                 return
             elif mrow_num > 1 and (e.key() in [Qt.Key_Return, Qt.Key_Enter, Qt.Key_Backspace, Qt.Key_Delete] or e.text() != ''):
                 self.insert_cell(mrow)
                 cell_idx = mrow
                 self.remove_cells(mrow+1, mrow_num)
+                self.schedule_save()
                 if e.key() in [Qt.Key_Return, Qt.Key_Enter, Qt.Key_Backspace, Qt.Key_Delete]:
                     if cell_idx == 0:
                         self.execute(0) # to show splash
@@ -889,6 +2193,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                         self.execute(cell_idx + 1)
                     else:
                         self.execute(cell_idx)
+                self.schedule_save()
                 return
             elif e.key() == Qt.Key_Backspace:
                 if (not cursor.hasSelection() and
@@ -902,6 +2207,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                     cursor.setPosition(pos)
                     self.setTextCursor(cursor)
                     self.execute(cell_idx-1)
+                    self.schedule_save()
                     return
             elif e.key() == Qt.Key_Delete:
                 if (not cursor.hasSelection() and
@@ -913,7 +2219,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                     self.setTextCursor(cursor)
                     self.remove_cells(cell_idx+1, 1)
                     self.execute(cell_idx)
-                    self.save_timer.start()
+                    self.schedule_save()
                     return
             # shift+tab gives backtab:
             elif e.key() == Qt.Key_Backtab or (e.key() == Qt.Key_Tab and (e.modifiers() & Qt.ShiftModifier)):
@@ -929,7 +2235,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                     if cursor.selectedText() == ' ':
                         cursor.removeSelectedText()
                 self.execute(cell_idx)
-                self.save_timer.start()
+                self.schedule_save()
                 return
             elif e.key() == Qt.Key_Tab:
                 if cursor.hasSelection():
@@ -945,11 +2251,9 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
                     if check_cursor.selectedText().isspace() or check_cursor.selectedText() == '':
                         cursor.insertText('    ')
                         self.execute(cell_idx)
-                        self.save_timer.start()
-                    else:
-                        self.complete_cell_idx, self.complete_pos_in_cell = self.cell_idx_and_pos_in_cell(cursor)
-                        self.complete_code = self.get_cell_code(self.complete_cell_idx)
-                        self.complete_msg_id = self.kernel_client.complete(code=self.complete_code, cursor_pos=self.complete_pos_in_cell)
+                        self.schedule_save()
+                    elif self.kernel_ready():
+                        self.request_completion()
                 return
 
             old_code = self.get_cell_code(cell_idx)
@@ -957,10 +2261,12 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
             code = self.get_cell_code(cell_idx)
             if code != old_code:
                 self.execute(cell_idx, code)
-                self.save_timer.start()
+                self.schedule_save()
+                # ask ahead, so Enter finds the kernel's answer cached
+                self.request_is_complete(code[:self.cell_idx_and_pos_in_cell(self.textCursor())[1]])
 
             if e.text() == '(':
-                self.inspect()
+                self.inspect_timer.start()
 
     def createMimeDataFromSelection(self) -> QMimeData:
         mime_data = QMimeData()
@@ -999,6 +2305,16 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         mime_data.setText(text.replace('\u2028', '\n'))
         return mime_data
 
+    def dropEvent(self, event):
+        # moving text within the pad removes it from where it was dragged, record that too
+        source_cell_idx = self.cell_idx_and_pos_in_cell(self.textCursor())[0]
+        with self.edit_block(), self.undoable():
+            super().dropEvent(event)
+        cell_idx = self.cell_idx_and_pos_in_cell(self.textCursor())[0]
+        if 0 <= source_cell_idx < min(cell_idx, self.table.rows()):
+            self.execute(source_cell_idx)
+            self.schedule_save()
+
     def insertFromMimeData(self, mime_data: QMimeData):
         if mime_data.hasUrls():
             if mime_data.urls()[0].isLocalFile():
@@ -1012,9 +2328,8 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         lines = text.split('\n')
         if lines[-1] == '': # ignore last new line
             lines.pop()
-        lines.reverse()
 
-        with self.edit_block():
+        with self.edit_block(), self.undoable():
             cursor = self.textCursor()
             cell = self.table.cellAt(cursor)
             if not cell.isValid():
@@ -1032,45 +2347,42 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
 
             execute_cell_idx = cell_idx
             if len(lines) == 1:
-                cursor.insertText(lines.pop())
+                cursor.insertText(lines[0])
             else:
                 cursor.setPosition(self.code_cell(cell_idx).lastCursorPosition().position(), QTextCursor.KeepAnchor)
                 code_after_cursor = cursor.selection().toPlainText()
                 cursor.removeSelectedText()
 
-                lines_to_insert = ''
-                while lines:
-                    lines_to_insert += lines.pop()
-                    is_complete, indent = self.is_complete(lines_to_insert.replace('\u2028', '\n'))
-                    if is_complete == 'incomplete' and lines:
-                        lines_to_insert += '\u2028'
-                    else: # complete or invalid or no more lines
-                        if mrow_num <= 0: # no need if we already inserted before
-                            cell_idx += 1
-                            self.insert_cell(cell_idx)
-                        mrow_num = -1
-                        self.textCursor().insertText(lines_to_insert)
-                        self.log.debug(f'inserting: {lines_to_insert}')
-                        lines_to_insert = ''
+                codes = self.split_statements(lines)
+                self.log.debug(f'inserting: {codes}')
+                if mrow_num > 0 and codes: # the selected cells were already replaced by an empty cell
+                    self.textCursor().insertText(codes.pop(0))
+                last_cell_idx = cell_idx + len(codes)
                 if code_after_cursor != '':
-                    self.insert_cell(cell_idx+1)
-                    self.textCursor().insertText(code_after_cursor)
-                self.setTextCursor(self.code_cell(cell_idx).lastCursorPosition())
+                    codes.append(code_after_cursor)
+                self.insert_cells(cell_idx+1, codes)
+                self.setTextCursor(self.code_cell(last_cell_idx).lastCursorPosition())
 
             self.execute(execute_cell_idx)
+            self.schedule_save()
 
     @pyqtSlot()
     def recalculate_columns(self):
         if QGuiApplication.mouseButtons() == Qt.LeftButton:
             self.recalculate_columns_timer.start()
             return
-        table_format = self.table.format()
-        width = self.viewport().width()*table_format.columnWidthConstraints()[1].rawValue()/100
+        self.rerasterize_svgs()
+        if not self.kernel_ready():
+            return # sent upon kernel_info_reply
         padding = 10
-        columns = int((width-padding) // self.char_width)
+        columns = int(self.out_column_width() // self.char_width)
         lines = int((self.viewport().height()-padding) // self.char_height)
         # on linux shutil.get_terminal_size() looks at a wrapper of stdout and fails, on windows we are in gui mode, no terminal
-        self.kernel_client.execute(f'import os\nos.environ["COLUMNS"] = "{columns}"\nos.environ["LINES"] = "{lines}"', silent=True, stop_on_error=False)
+        self.ignore_msg_id(self.kernel_client.execute(f'import os\nos.environ["COLUMNS"] = "{columns}"\nos.environ["LINES"] = "{lines}"', silent=True, stop_on_error=False))
+        if self.kernel_name in ['python3', 'sagemath']:
+            # figures are rendered at the size they are shown, rather than scaled down
+            self.ignore_msg_id(self.kernel_client.execute(
+                f"__import__('jupad_kernel').set_figure_size({self.out_column_width()}, {self.devicePixelRatioF()})", silent=True, stop_on_error=False))
         # new output would use the new width
         self.execute(0)
 
@@ -1113,6 +2425,13 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         else:
             super().mousePressEvent(event)
 
+    def mouseDoubleClickEvent(self, event):
+        cell = self.table.cellAt(self.cursorForPosition(event.pos()))
+        if cell.isValid() and cell.column() == 1 and self.truncated[cell.row()]:
+            self.request_full_output(cell.row())
+        else:
+            super().mouseDoubleClickEvent(event)
+
     def mouseMoveEvent(self, event):
         if self.divider_drag:
             delta_x = event.pos().x() - self.divider_drag_start_pos.x()
@@ -1132,7 +2451,7 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
             super().mouseReleaseEvent(event)
 
     def user_open_file(self):
-        dir = os.path.dirname(self.file.name) if self.file else ''
+        dir = os.path.dirname(self.file_path) if self.file_path else ''
         file_path, sel_filter = QFileDialog.getOpenFileName(self, 'Open File', dir, 'Python Files (*.py);;All Files (*)')
         if file_path:
             self.open_file(file_path)
@@ -1141,73 +2460,301 @@ class JupadTextEdit(QTextEdit, BaseFrontendMixin):
         self.save_file()
         try:
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            self.file = open(file_path, 'a+')
+            open(file_path, 'a').close()
         except Exception as e:
             self.log.exception('file open error')
             QMessageBox(QMessageBox.Icon.Critical, 'File Open Error', f'Failed to open "{file_path}"\n{type(e).__name__}: {e}').exec()
             if retry:
                 self.user_open_file()
             return
-        self.parent().setWindowTitle(os.path.basename(file_path))
-        self.log.debug(f'open_file: {self.file.name}')
+        if self.file_path is not None:
+            self.file_watcher.removePath(self.file_path)
+        self.file_path = file_path
+        self.file_watcher.addPath(file_path)
+        self.saved_text = None
+        self.journal_codes = None
+        self.journal_timer.stop()
+        self.update_title()
+        self.log.debug(f'open_file: {self.file_path}')
         if load:
-            self.load_file(self.file)
+            self.load_file()
 
     def user_save_file_as(self):
-        dir = os.path.dirname(self.file.name) if self.file else ''
+        dir = os.path.dirname(self.file_path) if self.file_path else ''
         file_path, sel_filter = QFileDialog.getSaveFileName(self, 'Save File As', dir, 'Python Files (*.py);;All Files (*)')
         if file_path:
             self.open_file(file_path, retry=False, load=False)
             self.save_file()
 
+    def schedule_save(self):
+        self.save_timer.start()
+        if self.journal:
+            self.journal_timer.start()
+
+    def journal_path(self):
+        dir_path, base_name = os.path.split(self.file_path)
+        return os.path.join(dir_path, f'.{base_name}.journal')
+
+    @staticmethod
+    def codes_text(codes):
+        return ''.join(f'# %%\n{code}\n' for code in codes)
+
     @pyqtSlot()
     def save_file(self):
-        if self.file is None:
+        if self.file_path is None:
+            return
+        # only edited cells are extracted again
+        text = self.codes_text(self.get_codes())
+        if text == self.saved_text:
             return
         self.log.debug('save_file')
-        try:
-            self.file.seek(0)
-            self.file.truncate()
-            for i in range(self.table.rows()):
-                self.file.write('# %%\n')
-                self.file.write(self.get_cell_code(i))
-                self.file.write('\n')
-            self.file.flush()
-            # os.fsync(self.file.fileno()) # not really needed and io.StringIO has no fileno
-        except Exception:
-            self.log.exception(f'file save error')
+        # the journal is removed once the file is written, it starts over with a full entry
+        self.journal_codes = None
+        writer = FileWriter(self.file_path, text, remove_path=self.journal_path())
+        # a failed write leaves saved_text behind, so the next save tries again
+        writer.signals.written.connect(self.file_written)
+        self.save_pool.start(writer)
+
+    @pyqtSlot(str, str)
+    def file_written(self, path, text):
+        if path == self.file_path:
+            self.saved_text = text
 
-    def load_file(self, file):
-        self.log.debug('load_file')
-        self.insert_cell(0)
-        self.remove_cells(1, self.table.rows()-1)
+    @pyqtSlot()
+    def write_journal(self):
+        if self.file_path is None:
+            return
+        codes = self.get_codes()
+        if self.journal_codes is None or len(codes) != len(self.journal_codes):
+            entry = {'cells': codes}
+        else:
+            changed = {i: code for i, (code, journal_code) in enumerate(zip(codes, self.journal_codes)) if code != journal_code}
+            if not changed:
+                return
+            entry = {'changed': changed}
+        self.journal_codes = codes
+        self.save_pool.start(FileWriter(self.journal_path(), json.dumps(entry) + '\n', append=True))
+
+    def replay_journal(self, codes):
+        '''apply the journal left by a jupad that didn't get to save, returns the codes or None if there is no journal'''
+        try:
+            with open(self.journal_path()) as f:
+                lines = f.readlines()
+        except OSError:
+            return None
+        if not lines:
+            return None
+        codes = list(codes)
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break # partially written
+            if 'cells' in entry:
+                codes = entry['cells']
+            else:
+                for i, code in entry['changed'].items():
+                    if int(i) < len(codes):
+                        codes[int(i)] = code
+        self.log.info(f'recovered unsaved edits from {self.journal_path()}')
+        return codes
+
+    @staticmethod
+    def split_cells(text):
         def rstrip(s):
             # remove single new line
-            return s[:-1] if s[-1] == '\n' else s
+            return s[:-1] if s.endswith('\n') else s
+        cells = re.split(r'^[ \t]*#[ \t]*%%.*\n', text, flags=re.MULTILINE)
+        if cells and cells[0] == '':
+            cells.pop(0) # first empty from split
+        return [rstrip(cell) for cell in cells] or ['']
+
+    @staticmethod
+    def merge_cells(base, local, remote):
+        '''three way merge of cell lists, returns (codes, number of conflicts), local wins conflicts'''
+        sides = [local, remote]
+        # changes of both sides that overlap, or insert at the same place, are merged into one group
+        hunks = sorted((i1, i2, j2 - j1 - (i2 - i1), side_idx) for side_idx, side in enumerate(sides) for tag, i1, i2, j1, j2
+                       in difflib.SequenceMatcher(None, base, side, autojunk=False).get_opcodes() if tag != 'equal')
+        groups = []
+        for hunk in hunks:
+            if groups and (hunk[0] < groups[-1][1] or hunk[0] == hunk[1] == groups[-1][0] == groups[-1][1]):
+                groups[-1][1] = max(groups[-1][1], hunk[1])
+                groups[-1][2].append(hunk)
+            else:
+                groups.append([hunk[0], hunk[1], [hunk]])
+        codes = []
+        conflicts = 0
+        base_idx = 0
+        offsets = [0, 0] # side index - base index, before the group
+        for lo, hi, group in groups:
+            codes += base[base_idx:lo]
+            segments = [None, None]
+            for side_idx, side in enumerate(sides):
+                growths = [growth for _, _, growth, hunk_side_idx in group if hunk_side_idx == side_idx]
+                if growths:
+                    offset = offsets[side_idx]
+                    offsets[side_idx] += sum(growths)
+                    segments[side_idx] = side[lo+offset:hi+offsets[side_idx]]
+            local_segment, remote_segment = segments
+            if local_segment is not None and remote_segment is not None and local_segment != remote_segment:
+                conflicts += 1
+            codes += local_segment if local_segment is not None else remote_segment
+            base_idx = hi
+        codes += base[base_idx:]
+        return codes, conflicts
+
+    def load_file(self):
+        self.log.debug('load_file')
+        # edits and outputs of the previous file don't apply to this one
+        self.undo_history = UndoHistory()
+        self.output_cache.clear()
+        codes = ['']
         try:
-            file.seek(0)
-            cells = re.split(r'^[ \t]*#[ \t]*%%.*\n', file.read(), flags=re.MULTILINE)
-            if cells and cells[0] == '':
-                cells.pop(0) # first empty from split
-            if cells:
-                for cell in cells[:-1]:
-                    self.textCursor().insertText(rstrip(cell))
-                    self.insert_cell(self.table.rows())
-                self.textCursor().insertText(rstrip(cells[-1]))
+            with open(self.file_path) as f:
+                codes = self.split_cells(f.read())
         except Exception:
             self.log.exception(f'file load error')
-        if self.kernel_info != '': # kernel is ready
-            self.execute(0)
+        recovered_codes = self.replay_journal(codes)
+        if recovered_codes is not None:
+            codes = recovered_codes or ['']
+        else:
+            self.saved_text = self.codes_text(codes)
+        # only the head of large pads is materialized
+        self.virtual_cells = codes[self.materialize_chunk:]
+        rows = self.table.rows()
+        self.setUpdatesEnabled(False)
+        try:
+            # new cells first, the table can't be left without rows
+            self.insert_cells(0, codes[:self.materialize_chunk])
+            self.remove_cells(self.table.rows()-rows, rows)
+        finally:
+            self.setUpdatesEnabled(True)
+        if recovered_codes is not None:
+            self.save_file()
+        self.execute(0)
+
+    @pyqtSlot(str)
+    def file_changed(self, path):
+        self.file_changed_timer.start()
+
+    @pyqtSlot()
+    def reload_file(self):
+        if self.file_path is None:
+            return
+        if self.save_pool.activeThreadCount():
+            self.file_changed_timer.start() # our own save, wait for it to land
+            return
+        # replaced files (renamed over, like our saves) are no longer watched
+        if self.file_path not in self.file_watcher.files():
+            self.file_watcher.addPath(self.file_path)
+        try:
+            with open(self.file_path) as f:
+                text = f.read()
+        except OSError:
+            return # removed, the next save creates it again
+        if text == self.saved_text:
+            return
+        self.log.debug('file changed externally')
+        codes = self.get_codes()
+        # edits not saved yet are kept, merged with the external change
+        base = self.split_cells(self.saved_text) if self.saved_text is not None else codes
+        remote = self.split_cells(text)
+        merged, conflicts = self.merge_cells(base, codes, remote)
+        if conflicts:
+            self.log.info(f'file changed externally, kept the local edits of {conflicts} conflicting cells')
+        self.saved_text = text
+        self.journal_codes = None
+        cursor = self.cell_idx_and_pos_in_cell(self.textCursor())
+        self.patch_cells(merged)
+        self.record_edit(0, codes, merged, cursor)
+        if merged != remote:
+            self.schedule_save()
+
+    def patch_cells(self, new_codes, cursor=None):
+        '''update the pad to the given codes, touching only the cells that differ,
+        the cursor is put at the given (cell_idx, pos_in_cell), or stays where it was'''
+        codes = self.get_codes()
+        opcodes = [opcode for opcode in difflib.SequenceMatcher(None, codes, new_codes, autojunk=False).get_opcodes()
+                   if opcode[0] != 'equal']
+        if opcodes:
+            self.patch(opcodes, new_codes, cursor)
+
+    def patch(self, opcodes, new_codes, cursor=None):
+        '''apply the difflib opcodes turning the pad's codes into new_codes'''
+        # cells before the first change keep their outputs
+        first_cell_idx = opcodes[0][1]
+        if self.execute_running:
+            first_cell_idx = min(first_cell_idx, self.execute_cell_idx)
+        self.stop_execution()
+        cursor_cell_idx, cursor_pos = cursor or self.cell_idx_and_pos_in_cell(self.textCursor())
+        with self.edit_block():
+            # from the end, so the indices of earlier opcodes stay valid
+            for tag, i1, i2, j1, j2 in reversed(opcodes):
+                rows = self.table.rows()
+                if i1 >= rows and self.virtual_cells:
+                    self.virtual_cells[i1-rows:i2-rows] = new_codes[j1:j2]
+                    continue
+                table_i2 = min(i2, rows)
+                table_j2 = min(j2, j1 + table_i2 - i1) if i2 > rows else j2
+                if i2 > rows:
+                    self.virtual_cells[:i2-rows] = new_codes[table_j2:j2]
+                self.patch_rows(i1, table_i2, new_codes[j1:table_j2])
+        rows = self.table.rows()
+        cursor_cell_idx = max(0, min(cursor_cell_idx, rows-1))
+        cell = self.code_cell(cursor_cell_idx)
+        cursor = cell.firstCursorPosition()
+        cursor.setPosition(min(cell.firstCursorPosition().position() + max(0, cursor_pos), cell.lastCursorPosition().position()))
+        self.setTextCursor(cursor)
+        if first_cell_idx < rows:
+            self.execute(first_cell_idx)
+
+    def patch_rows(self, cell_idx, end_cell_idx, codes):
+        '''replace the table rows cell_idx..end_cell_idx with cells of the given codes'''
+        common = min(end_cell_idx - cell_idx, len(codes))
+        for i in range(common):
+            if self.get_cell_code_cached(cell_idx+i) != codes[i]:
+                cell = self.code_cell(cell_idx+i)
+                cursor = cell.firstCursorPosition()
+                cursor.setPosition(cell.lastCursorPosition().position(), QTextCursor.KeepAnchor)
+                cursor.insertText(codes[i])
+        if len(codes) > common:
+            self.insert_cells(cell_idx+common, codes[common:])
+        elif end_cell_idx - cell_idx > common:
+            if self.table.rows() == end_cell_idx - cell_idx - common:
+                # the table can't be left without rows, the rest of the pad is virtual
+                self.insert_cells(self.table.rows(), self.virtual_cells[:1])
+                del self.virtual_cells[:1]
+            self.remove_cells(cell_idx+common, end_cell_idx - cell_idx - common)
 
     def closeEvent(self, event: QCloseEvent):
         self.log.debug('close event')
         self.parent().hide()
+        self.save_timer.stop()
+        self.journal_timer.stop()
+        self.file_changed_timer.stop()
         self.save_file()
         self.executing_animation.stop()
+        self.kernel_memory_timer.stop()
+        self.kernel_info_timer.stop()
+        self.inspect_timer.stop()
+        self.input_timer.stop()
+        self.spare_kernel_timer.stop()
+        if self.own_kernel_pool:
+            self.kernel_pool.shutdown()
+        launchers = [launcher for launcher in [self.kernel_launcher, self.spare_kernel_launcher] if launcher is not None]
+        if launchers:
+            # closed while launching, wait for the kernels so they won't be left running
+            self.thread_pool.waitForDone()
+            for launcher in launchers:
+                if launcher.kernel_manager is not None:
+                    launcher.kernel_manager.shutdown_kernel(now=True)
+            self.kernel_launcher = None
+            self.spare_kernel_launcher = None
         if self.kernel_manager:
+            self.kernel_client.stop_channels()
             self.kernel_manager.shutdown_kernel(now=True)
-        if self.file:
-            self.file.close()
+        self.save_pool.waitForDone()
         return super().closeEvent(event)
 
 class MainWindow(QMainWindow):
@@ -1230,3 +2777,38 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event: QCloseEvent):
         self.jupad_text_edit.closeEvent(event)
         return super().closeEvent(event)
+
+class Pads:
+    '''the pad windows of the process, they share a kernel pool'''
+    def __init__(self, kernel_pool_size=1):
+        self.kernel_pool = KernelPool(kernel_pool_size)
+        self.windows = []
+        QApplication.instance().aboutToQuit.connect(self.kernel_pool.shutdown)
+        # one hook for the process, the exit takes all pads down, so all of them are saved
+        sys.excepthook = self.exception_hook
+
+    def exception_hook(self, etype, value, tb):
+        sys.__excepthook__(etype, value, tb)
+        msg = ''.join(traceback.format_exception(etype, value, tb))
+        QMessageBox(QMessageBox.Icon.Critical, 'Exception', msg).exec()
+        try: logging.getLogger('jupad').error(msg)
+        except: pass
+        for window in self.windows:
+            try:
+                window.jupad_text_edit.save_file()
+                window.jupad_text_edit.save_pool.waitForDone()
+            except: pass
+        sys.exit(1)
+
+    def open(self, pad_kwargs):
+        '''a window for the pad of the given MainWindow arguments, an open pad of the file is raised instead'''
+        self.windows = [window for window in self.windows if window.isVisible()]
+        file_path = os.path.realpath(pad_kwargs['file_path'])
+        for window in self.windows:
+            if os.path.realpath(window.jupad_text_edit.file_path) == file_path:
+                window.raise_()
+                window.activateWindow()
+                return window
+        window = MainWindow(kernel_pool=self.kernel_pool, **pad_kwargs)
+        self.windows.append(window)
+        return window
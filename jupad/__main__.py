@@ -2,10 +2,6 @@ import os
 import sys
 import argparse
 
-from PyQt6.QtWidgets import QApplication
-from PyQt6.QtGui import QIcon
-from jupad import MainWindow
-
 if os.name == 'nt':
     # for taskbar icon
     try:
@@ -18,9 +14,45 @@ def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--debug', action='store_true', help=argparse.SUPPRESS)
     parser.add_argument('--kernel', type=str, default='python3', help='kernel name to use (`jupyter kernelspec list` to see available kernels)')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds a cell may run before it is interrupted, escalating to a kernel restart (0 to disable)')
+    parser.add_argument('--input-timeout', type=float, default=30, help='seconds input() waits for an answer in the output before getting an empty one (0 to wait until the pad moves on)')
+    parser.add_argument('--replay-input', action='store_true', help='answer input() with the answer it got before, when its cell runs again with the same code and prompt')
+    parser.add_argument('--memory-limit', type=int, default=0, help='kernel address space limit in MB, allocations beyond it fail (0 for no limit, linux only)')
+    parser.add_argument('--cpu-limit', type=int, default=0, help='kernel CPU time limit in seconds, the kernel is restarted when exceeded (0 for no limit, linux only)')
+    parser.add_argument('--daemon', action='store_true', help='keep prewarmed kernels running in the background, jupad launches claim them')
+    parser.add_argument('--daemon-pool', type=int, default=1, help='amount of ready kernels the daemon keeps')
+    parser.add_argument('--preload', nargs='*', default=[], metavar='MODULE', help='modules the daemon imports in its kernels')
+    parser.add_argument('--journal', action='store_true', help='append edits to a journal next to the file, to recover them if jupad crashes before saving')
+    parser.add_argument('--kernel-pool', type=int, default=1, help='spare kernels kept ready for restarts and new pads, shared by the pads')
+    parser.add_argument('--new-instance', action='store_true', help="don't open the file in the running jupad, start a separate one")
     parser.add_argument('file', nargs='?', default=os.path.expanduser(os.path.join('~','.jupad','jupad.py')), help='script file to open')
     args = parser.parse_args()
 
+    if args.daemon:
+        from jupad.daemon import main as daemon_main
+        daemon_main(args.kernel, args.daemon_pool, args.preload, args.debug)
+        return
+
+    if args.kernel != 'python3':
+        from jupyter_client.kernelspec import KernelSpecManager
+        kernels = KernelSpecManager().find_kernel_specs()
+        if args.kernel not in kernels:
+            print(f'No such kernel: {args.kernel}, available kernels: {", ".join(kernels)}')
+            sys.exit(1)
+
+    pad_kwargs = dict(file_path=os.path.abspath(args.file), kernel_name=args.kernel, debug=args.debug, timeout=args.timeout,
+                      memory_limit=args.memory_limit, cpu_limit=args.cpu_limit, journal=args.journal, input_timeout=args.input_timeout,
+                      replay_input=args.replay_input, cwd=os.getcwd())
+    if not args.new_instance:
+        # a running jupad opens it in a new window, sharing its process and kernels
+        from jupad.instance import send_to_instance
+        if send_to_instance(pad_kwargs):
+            return
+
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtGui import QIcon
+    from jupad import Pads
+
     app = QApplication([])
     if os.name == 'nt':
         app.setStyle('windows11')
@@ -30,14 +62,13 @@ def main():
     app.icon = QIcon(icon_path)
     app.setWindowIcon(app.icon)
 
-    if args.kernel != 'python3':
-        from jupyter_client.kernelspec import KernelSpecManager
-        kernels = KernelSpecManager().find_kernel_specs()
-        if args.kernel not in kernels:
-            print(f'No such kernel: {args.kernel}, available kernels: {", ".join(kernels)}')
-            sys.exit(1)
-
-    main_window = MainWindow(file_path=args.file, kernel_name=args.kernel, debug=args.debug)
+    pads = Pads(args.kernel_pool)
+    if not args.new_instance:
+        from jupad.instance import InstanceServer
+        instance_server = InstanceServer()
+        instance_server.open_requested.connect(pads.open)
+        instance_server.listen()
+    pads.open(pad_kwargs)
     sys.exit(app.exec())
 
 if __name__ == '__main__':
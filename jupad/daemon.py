@@ -0,0 +1,181 @@
+'''jupad kernel daemon
+
+keeps prewarmed kernels ready for jupad launches (`jupad --daemon`). Every ready kernel has a connection
+file `ready-<id>.json` in daemon_dir, with the kernel pid and name added. jupad claims a kernel by renaming
+its file to `claimed-<id>.json` (atomic, so each kernel goes to a single jupad), the daemon then starts
+a replacement. The daemon itself uses no Qt, but `jupad --daemon` still imports the jupad package first.
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import logging
+import subprocess
+
+from jupyter_core.paths import secure_write
+
+daemon_dir = os.path.expanduser(os.path.join('~', '.jupad', 'daemon'))
+
+def kernel_launch_args(kernel_name):
+    '''extra arguments and environment for launching a jupad kernel'''
+    extra_arguments = []
+    env = os.environ.copy()
+    if kernel_name in ['python3', 'sagemath']: # mathics?
+        extra_arguments.append('--InteractiveShell.ast_node_interactivity=last_expr_or_assign')
+        # every keystroke is an execution, don't log them all to the ipython history file
+        extra_arguments.append('--HistoryManager.hist_file=:memory:')
+        # jupad_kernel extension limits the formatting of results
+        extra_arguments.append('--ext=jupad_kernel')
+        kernel_ext_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'kernel')
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [kernel_ext_path, env.get('PYTHONPATH')]))
+    return extra_arguments, env
+
+def process_command_line(pid):
+    '''the command line of the process, or None if there is none'''
+    if os.path.exists('/proc/self/cmdline'):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                return f.read().replace(b'\0', b' ').decode(errors='replace')
+        except OSError:
+            return None
+    try:
+        result = subprocess.run(['ps', '-ww', '-p', str(pid), '-o', 'command='], capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def kernel_alive(pid, kernel_file):
+    '''whether the kernel the daemon started with the connection file kernel_file still runs as pid,
+    pids are reused, so the process is recognized by the connection file on its command line'''
+    if not isinstance(pid, int) or not kernel_file:
+        return False
+    command_line = process_command_line(pid)
+    return command_line is not None and kernel_file in command_line
+
+def claim_kernel(kernel_name):
+    '''claim a ready kernel of the daemon, returns its connection info (with 'connection_file') or None'''
+    if os.name != 'posix':
+        return None
+    try:
+        names = sorted(os.listdir(daemon_dir))
+    except OSError:
+        return None
+    for name in names:
+        if not (name.startswith('ready-') and name.endswith('.json')):
+            continue
+        path = os.path.join(daemon_dir, name)
+        claimed_path = os.path.join(daemon_dir, 'claimed-' + name[len('ready-'):])
+        try:
+            with open(path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if info.get('kernel_name') != kernel_name:
+            continue
+        try:
+            os.rename(path, claimed_path)
+        except OSError:
+            continue # claimed by another jupad
+        if not kernel_alive(info.get('pid'), info.get('kernel_file')):
+            os.remove(claimed_path)
+            continue
+        info['connection_file'] = claimed_path
+        return info
+    return None
+
+class KernelDaemon:
+    def __init__(self, kernel_name='python3', pool_size=1, preload=()):
+        self.kernel_name = kernel_name
+        self.pool_size = pool_size
+        self.preload = list(preload)
+        self.ready = {} # connection file -> kernel manager
+        self.claimed = [] # kernel managers, to reap their processes
+        self.exiting = False
+        self.log = logging.getLogger('jupad.daemon')
+
+    def start_kernel(self):
+        from jupyter_client import KernelManager
+        kernel_id = uuid.uuid4().hex
+        kernel_manager = KernelManager(kernel_name=self.kernel_name,
+                                       connection_file=os.path.join(daemon_dir, f'kernel-{kernel_id}.json'))
+        extra_arguments, env = kernel_launch_args(self.kernel_name)
+        # claimed kernels outlive the daemon
+        kernel_manager.start_kernel(extra_arguments=extra_arguments, env=env, independent=True)
+        kernel_client = kernel_manager.blocking_client()
+        kernel_client.start_channels()
+        try:
+            kernel_client.wait_for_ready(timeout=60)
+            if self.preload:
+                reply = kernel_client.execute_interactive(f'import {", ".join(self.preload)}', silent=True, timeout=120)
+                if reply['content']['status'] != 'ok':
+                    self.log.error(f'preload failed: {reply["content"].get("evalue")}')
+        except Exception:
+            self.log.exception('kernel start error')
+            kernel_manager.shutdown_kernel(now=True)
+            return
+        finally:
+            kernel_client.stop_channels()
+
+        info = kernel_manager.get_connection_info()
+        info['key'] = info['key'].decode()
+        info['pid'] = kernel_manager.provisioner.pid
+        info['kernel_file'] = kernel_manager.connection_file # the kernel was started with, see kernel_alive
+        info['kernel_name'] = self.kernel_name
+        path = os.path.join(daemon_dir, f'ready-{kernel_id}.json')
+        # holds the kernel's key, readable only by us
+        with secure_write(path + '.tmp') as f:
+            json.dump(info, f)
+        os.replace(path + '.tmp', path)
+        self.ready[path] = kernel_manager
+        self.log.info(f'kernel ready: {path}')
+
+    def poll(self):
+        for path, kernel_manager in list(self.ready.items()):
+            if not os.path.exists(path):
+                self.log.info(f'kernel claimed: {path}')
+                del self.ready[path]
+                self.claimed.append(kernel_manager)
+            elif not kernel_manager.is_alive():
+                self.log.info(f'kernel died: {path}')
+                del self.ready[path]
+                os.remove(path)
+                kernel_manager.cleanup_resources()
+        # is_alive() reaps processes that were shut down by their jupad
+        claimed = []
+        for kernel_manager in self.claimed:
+            if kernel_manager.is_alive():
+                claimed.append(kernel_manager)
+            else:
+                kernel_manager.cleanup_resources()
+        self.claimed = claimed
+        # one at a time, so we keep polling while the pool fills
+        if len(self.ready) < self.pool_size and not self.exiting:
+            self.start_kernel()
+
+    def stop(self, *args):
+        self.exiting = True
+
+    def run(self):
+        os.makedirs(daemon_dir, mode=0o700, exist_ok=True)
+        os.chmod(daemon_dir, 0o700) # also when an earlier jupad created it
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.log.info(f'jupad daemon: {self.pool_size} {self.kernel_name} kernels, preload: {self.preload}')
+        while not self.exiting:
+            self.poll()
+            time.sleep(0.5)
+        for path, kernel_manager in self.ready.items():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            kernel_manager.shutdown_kernel(now=True)
+
+def main(kernel_name='python3', pool_size=1, preload=(), debug=False):
+    if os.name != 'posix':
+        print('jupad daemon is supported only on posix')
+        sys.exit(1)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG if debug else logging.INFO)
+    KernelDaemon(kernel_name, pool_size, preload).run()
@@ -0,0 +1,98 @@
+'''single jupad instance
+
+a jupad started while another one is running hands its file to it (send_to_instance) and exits, the running
+jupad opens the file in a new window, so all pads share one process and its kernel pool. Requests are a json
+line with the pad's arguments, answered by 'ok' or by 'error: <reason>'. The pad's kernel starts in the
+directory jupad was started from (python kernels), the environment is the running jupad's.
+'''
+import sys
+import json
+import getpass
+
+from PyQt6.QtCore import QObject, pyqtSignal, pyqtSlot
+from PyQt6.QtNetwork import QLocalServer, QLocalSocket
+
+# the pad arguments a request may have, and their types
+pad_arguments = {'file_path': str, 'kernel_name': str, 'debug': bool, 'timeout': (int, float), 'memory_limit': int,
+                 'cpu_limit': int, 'journal': bool, 'input_timeout': (int, float), 'replay_input': bool,
+                 'cwd': str}
+
+def server_name():
+    return f'jupad-{getpass.getuser()}'
+
+def send_to_instance(pad_kwargs, name=None, timeout=5000):
+    '''ask the running jupad to open a pad, returns whether it did'''
+    socket = QLocalSocket()
+    socket.connectToServer(name or server_name())
+    if not socket.waitForConnected(500):
+        return False
+    socket.write((json.dumps(pad_kwargs) + '\n').encode())
+    reply = b''
+    while not reply.endswith(b'\n') and socket.waitForReadyRead(timeout):
+        reply += socket.readAll().data()
+    socket.disconnectFromServer()
+    if reply.startswith(b'error'):
+        print(f'jupad instance: {reply.decode().strip()}', file=sys.stderr)
+    return reply == b'ok\n'
+
+def invalid_pad_kwargs(pad_kwargs):
+    '''why the requested pad arguments are invalid, or None'''
+    if not isinstance(pad_kwargs, dict) or 'file_path' not in pad_kwargs:
+        return 'no file_path'
+    for key, value in pad_kwargs.items():
+        if key not in pad_arguments:
+            return f'unknown argument {key}'
+        if not isinstance(value, pad_arguments[key]):
+            return f'invalid {key}'
+    return None
+
+class InstanceServer(QObject):
+    open_requested = pyqtSignal(dict)
+
+    def __init__(self, name=None):
+        super().__init__()
+        self.name = name or server_name()
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self.server.newConnection.connect(self.new_connection)
+        self.buffers = {} # socket -> bytes received so far
+
+    def listen(self):
+        # a running jupad (maybe too slow to answer) keeps its socket, listening would take it over
+        probe = QLocalSocket()
+        probe.connectToServer(self.name)
+        if probe.waitForConnected(500):
+            probe.disconnectFromServer()
+            return False
+        # left behind by a jupad that crashed
+        QLocalServer.removeServer(self.name)
+        return self.server.listen(self.name)
+
+    @pyqtSlot()
+    def new_connection(self):
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.buffers[socket] = b''
+            socket.readyRead.connect(lambda socket=socket: self.read(socket))
+            socket.disconnected.connect(lambda socket=socket: self.buffers.pop(socket, None))
+            socket.disconnected.connect(socket.deleteLater)
+
+    def read(self, socket):
+        if socket not in self.buffers:
+            return
+        self.buffers[socket] += socket.readAll().data()
+        if not self.buffers[socket].endswith(b'\n'):
+            return
+        try:
+            pad_kwargs = json.loads(self.buffers.pop(socket))
+        except ValueError:
+            socket.disconnectFromServer()
+            return
+        error = invalid_pad_kwargs(pad_kwargs)
+        if error is not None:
+            socket.write(f'error: {error}\n'.encode())
+            socket.flush()
+            return
+        self.open_requested.emit(pad_kwargs)
+        socket.write(b'ok\n')
+        socket.flush()
@@ -0,0 +1,159 @@
+'''jupad kernel extension
+
+runs inside the kernel process, loaded with `--ext=jupad_kernel` (jupad adds this directory to PYTHONPATH),
+it must not import jupad or Qt. The frontend calls it with silent executions of `__import__('jupad_kernel').<func>(...)`
+'''
+import os
+import sys
+import time
+import base64
+
+from traitlets.config.loader import LazyConfigValue
+
+# skipped once formatting the result took longer than time_budget (seconds)
+expensive_formats = ['image/png', 'image/jpeg', 'image/svg+xml', 'text/latex', 'text/html', 'text/markdown']
+time_budget = 0.25
+
+# figures are rendered for the output column, its width in (logical) pixels and the device pixel ratio
+figure_size = None
+figure_dpi = 96 # of the logical pixels, so text is sized as in the frontend
+# what set_figure_size set last, settings that no longer hold it were changed by the user
+figure_rc = {}
+figure_print_kwargs = {}
+
+# In entries before history_pruned were pruned already, but those of history_kept
+history_pruned = 1
+history_kept = set()
+
+shell = None
+orig_format = None
+
+def terminal_size():
+    try:
+        columns = int(os.environ.get('COLUMNS', 80))
+        lines = int(os.environ.get('LINES', 24))
+    except ValueError:
+        columns, lines = 80, 24
+    return max(columns, 1), max(lines, 1)
+
+def png_width(data):
+    if isinstance(data, str):
+        data = base64.b64decode(data[:32])
+    return int.from_bytes(data[16:20], 'big') # IHDR chunk
+
+def user_unset(settings, values, last_values, defaults={}):
+    '''the values whose settings the user didn't set: missing, default or still what we set last'''
+    current = settings.to_dict().get('update', {}) if isinstance(settings, LazyConfigValue) else settings
+    return {key: value for key, value in values.items() if key not in current or current[key] == last_values.get(key)
+            or (key in defaults and current[key] == defaults[key])}
+
+def set_figure_size(width, device_pixel_ratio):
+    '''render matplotlib figures of the inline backend at the output column's width and pixel density'''
+    global figure_size, figure_rc, figure_print_kwargs
+    figure_size = (width, device_pixel_ratio)
+    rc = {'figure.figsize': [width / figure_dpi, width / figure_dpi * 0.75]}
+    # the density comes from the dpi figures are printed at, figure.dpi (and savefig.dpi following it) are left alone
+    print_kwargs = {'dpi': figure_dpi * device_pixel_ratio}
+    inline_config = sys.modules.get('matplotlib_inline.config')
+    if inline_config is not None and inline_config.InlineBackend.initialized():
+        # the inline backend is set up, assigning its traits updates its formatters
+        inline_backend = inline_config.InlineBackend.instance()
+        inline_backend.rc = {**inline_backend.rc, **user_unset(inline_backend.rc, rc, figure_rc)}
+        inline_backend.print_figure_kwargs = {**inline_backend.print_figure_kwargs,
+                                              **user_unset(inline_backend.print_figure_kwargs, print_kwargs, figure_print_kwargs)}
+    else:
+        # merged into the backend's defaults (or the user's config) once matplotlib is imported
+        config = shell.config.InlineBackend
+        config.rc.update(user_unset(config.rc, rc, figure_rc))
+        config.print_figure_kwargs.update(user_unset(config.print_figure_kwargs, print_kwargs, figure_print_kwargs))
+    if 'matplotlib' in sys.modules:
+        matplotlib = sys.modules['matplotlib']
+        matplotlib.rcParams.update(user_unset(matplotlib.rcParams, rc, figure_rc, matplotlib.rcParamsDefault))
+    figure_rc, figure_print_kwargs = rc, print_kwargs
+
+def truncate_text(text, columns, lines):
+    '''truncate text to what fits in the output column, returns (text, truncated)'''
+    max_chars = columns * lines
+    text_lines = text.split('\n')
+    if len(text_lines) <= lines and len(text) <= max_chars:
+        return text, False
+    text = '\n'.join(text_lines[:lines-1])[:max_chars-columns]
+    return text + '\n…', True
+
+def limited_format(obj, include=None, exclude=None):
+    '''display_formatter.format, with a size budget for text/plain and a time budget for the rest'''
+    start = time.perf_counter()
+    columns, lines = terminal_size()
+    shell.display_formatter.formatters['text/plain'].max_width = columns
+    exclude = set(exclude or ())
+    wanted_formats = [t for t in expensive_formats if t not in exclude and (not include or t in include)]
+    format_dict, md_dict = orig_format(obj, include=include, exclude=exclude.union(expensive_formats))
+    if not format_dict and not (include and wanted_formats):
+        return format_dict, md_dict # handled by _ipython_display_ or nothing to show
+    truncated = []
+    if 'text/plain' in format_dict:
+        format_dict['text/plain'], is_truncated = truncate_text(format_dict['text/plain'], columns, lines)
+        if is_truncated:
+            truncated.append('text/plain')
+    for format_type in wanted_formats:
+        if time.perf_counter() - start > time_budget:
+            truncated.append(format_type)
+            continue
+        type_format_dict, type_md_dict = orig_format(obj, include=[format_type])
+        if (format_type == 'image/png' and format_type in type_format_dict and figure_size is not None and
+                type(obj).__module__.startswith('matplotlib')):
+            # rendered for the pixel density of the screen, shown at its width in logical pixels
+            type_md_dict.setdefault(format_type, {}).setdefault('width', round(png_width(type_format_dict[format_type]) / figure_size[1]))
+        format_dict.update(type_format_dict)
+        md_dict.update(type_md_dict)
+    if truncated:
+        md_dict['jupad'] = {'truncated': truncated}
+    return format_dict, md_dict
+
+def publish_full(execution_count):
+    '''publish the full (not truncated) output of the given execution as display_data'''
+    obj = shell.history_manager.output_hist.get(execution_count)
+    if obj is None:
+        return
+    shell.display_formatter.formatters['text/plain'].max_width = terminal_size()[0]
+    format_dict, md_dict = orig_format(obj)
+    if format_dict:
+        shell.display_pub.publish(format_dict, md_dict)
+
+def prune_history(keep):
+    '''forget outputs (Out, _N) and inputs (In, _iN) of executions not in keep'''
+    global history_pruned, history_kept
+    keep = set(keep)
+    history_manager = shell.history_manager
+    for execution_count in [n for n in history_manager.output_hist if n not in keep]:
+        del history_manager.output_hist[execution_count]
+        history_manager.output_hist_reprs.pop(execution_count, None)
+        shell.user_ns.pop(f'_{execution_count}', None)
+    # In is a list indexed by execution count, only blank the entries, those added since the last time
+    end = len(history_manager.input_hist_parsed)
+    for execution_count in (history_kept | set(range(history_pruned, end))) - keep:
+        for input_hist in (history_manager.input_hist_parsed, history_manager.input_hist_raw):
+            if execution_count < len(input_hist):
+                input_hist[execution_count] = ''
+        shell.user_ns.pop(f'_i{execution_count}', None)
+    history_pruned = end
+    history_kept = {n for n in keep if n < end}
+    # kept for writing to the history database, which jupad's kernels don't have (hist_file is :memory:)
+    with history_manager.db_input_cache_lock:
+        history_manager.db_input_cache.clear()
+    with history_manager.db_output_cache_lock:
+        history_manager.db_output_cache.clear()
+
+def load_ipython_extension(ipython):
+    global shell, orig_format
+    if shell is not None:
+        return
+    shell = ipython
+    orig_format = ipython.display_formatter.format
+    ipython.display_formatter.format = limited_format
+
+def unload_ipython_extension(ipython):
+    global shell, orig_format
+    if shell is not None:
+        del ipython.display_formatter.format
+        shell = orig_format = None
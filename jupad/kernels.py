@@ -0,0 +1,82 @@
+'''kernel manager and client classes, imported once a kernel is started, they pull in jupyter_client and zmq'''
+import os
+import signal
+from base64 import b64decode
+from collections import deque
+
+from PyQt6.QtGui import QImage
+from qtconsole.manager import QtKernelManager
+from qtconsole.client import QtKernelClient, QtZMQSocketChannel
+
+from jupad.daemon import kernel_alive
+
+class ClaimedKernelManager(QtKernelManager):
+    '''manager of a kernel claimed from the jupad daemon, the process isn't our child, so we go by its pid,
+    checking it is still the kernel (kernel_file) before signaling it'''
+    def __init__(self, pid, kernel_file, **kwargs):
+        super().__init__(**kwargs)
+        self.pid = pid
+        self.kernel_file = kernel_file
+        self.load_connection_file()
+
+    @property
+    def has_kernel(self):
+        return self.is_alive()
+
+    def is_alive(self):
+        return kernel_alive(self.pid, self.kernel_file)
+
+    def interrupt_kernel(self):
+        if self.is_alive():
+            os.kill(self.pid, signal.SIGINT)
+
+    def shutdown_kernel(self, now=False, restart=False):
+        if self.is_alive():
+            try:
+                os.kill(self.pid, signal.SIGKILL if now else signal.SIGTERM)
+            except OSError:
+                pass
+        self.cleanup_connection_file()
+
+class JupadIOPubChannel(QtZMQSocketChannel):
+    '''iopub channel that drops stale messages and decodes images in the ioloop thread,
+    so only messages jupad cares about reach the GUI thread'''
+    # still needed for stale executions, to know when the kernel runs them
+    stale_passthrough = ['execute_input', 'status']
+
+    def __init__(self, *args, **kwargs):
+        # before super().__init__, a running kernel's messages may arrive right away
+        self.stale_msg_ids = set()
+        self.stale_msg_ids_order = deque(maxlen=1024)
+        super().__init__(*args, **kwargs)
+
+    def ignore(self, msg_id):
+        # called from the GUI thread
+        if msg_id and msg_id not in self.stale_msg_ids:
+            if len(self.stale_msg_ids_order) == self.stale_msg_ids_order.maxlen:
+                self.stale_msg_ids.discard(self.stale_msg_ids_order[0])
+            self.stale_msg_ids_order.append(msg_id)
+            self.stale_msg_ids.add(msg_id)
+
+    def call_handlers(self, msg):
+        # called in the ioloop thread, msg is already deserialized here
+        if (msg['parent_header'].get('msg_id') in self.stale_msg_ids and
+            msg['header']['msg_type'] not in self.stale_passthrough):
+            return
+        if msg['header']['msg_type'] in ['execute_result', 'display_data']:
+            data = msg['content']['data']
+            for mime, format in [('image/png', 'PNG'), ('image/jpeg', 'JPG')]:
+                if mime in data:
+                    # QImage is safe to use outside the GUI thread
+                    image = QImage.fromData(b64decode(data[mime].encode('ascii')), format)
+                    # high density images (figures rendered for the screen) are shown at the width they were meant for
+                    width = msg['content'].get('metadata', {}).get(mime, {}).get('width')
+                    if isinstance(width, (int, float)) and width > 0 and image.width():
+                        image.setDevicePixelRatio(image.width() / float(width))
+                    msg['content']['jupad_image'] = image
+                    break
+        super().call_handlers(msg)
+
+class JupadKernelClient(QtKernelClient):
+    iopub_channel_class = JupadIOPubChannel
+    control_channel_class = QtZMQSocketChannel # completions are requested on it
@@ -0,0 +1,16 @@
+'''completion and call tip popups, imported on first use'''
+from qtconsole.completion_widget import CompletionWidget
+from qtconsole.call_tip_widget import CallTipWidget
+
+class CompletionWidget_(CompletionWidget):
+    def _complete_current(self):
+        with self._text_edit.undoable(self._text_edit.complete_cell_idx):
+            super()._complete_current()
+        self._text_edit.execute(self._text_edit.complete_cell_idx)
+
+class CallTipWidget_(CallTipWidget):
+    def __init__(self, text_edit):
+        super().__init__(text_edit)
+
+    def _format_tooltip(self, doc):
+        return self._text_edit.html_converter.convert(doc)
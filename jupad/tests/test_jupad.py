@@ -1,5 +1,8 @@
 
 import os
+import sys
+import subprocess
+import base64
 import shutil
 import logging
 import tempfile
@@ -9,8 +12,10 @@ from pytestqt.qtbot import QtBot
 # avoid DeprecationWarning https://github.com/jupyter/jupyter_core/issues/398
 os.environ["JUPYTER_PLATFORM_DIRS"] = "1"
 
-from PyQt6.QtCore import Qt
-from jupad import MainWindow, JupadTextEdit
+from PyQt6.QtCore import Qt, QUrl, QBuffer, QByteArray, QMimeData
+from PyQt6.QtGui import QImage
+from PyQt6.QtWidgets import QApplication
+from jupad import MainWindow, JupadTextEdit, LatexCache, UndoHistory, UndoEntry
 
 class LogHandler(logging.Handler):
     def emit(self, record):
@@ -47,7 +52,7 @@ test_file_content = '''# %%
 '''
 
 def test_file_load_save(jupad: JupadTextEdit, qtbot: QtBot):
-    orig_file_path = jupad.file.name
+    orig_file_path = jupad.file_path
     file_path = os.path.join(os.path.dirname(orig_file_path), 'test_file_load_save.py')
     with open(file_path, 'w') as f:
         f.write(test_file_content)
@@ -60,5 +65,552 @@ def test_file_load_save(jupad: JupadTextEdit, qtbot: QtBot):
     qtbot.keyClicks(jupad, '3')
     qtbot.waitUntil(lambda: jupad.get_cell_out(3) == '3')
     jupad.open_file(orig_file_path)
+    jupad.save_pool.waitForDone()
     with open(file_path, 'r') as f:
         assert f.read() == test_file_content + '# %%\n3\n'
+    assert [name for name in os.listdir(os.path.dirname(file_path)) if name.endswith('.tmp')] == []
+
+def test_save_edited_cells(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('a\nb')
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText('c')
+    jupad.save_file()
+    assert jupad.code_cache[0][1] == 'a\nb'
+    cached = jupad.code_cache[1]
+    cursor = jupad.code_cell(0).lastCursorPosition()
+    cursor.deletePreviousChar()
+    cursor.insertText('d')
+    jupad.save_file()
+    # only the edited cell was extracted again
+    assert jupad.code_cache[1] is cached
+    jupad.save_pool.waitForDone()
+    with open(jupad.file_path) as f:
+        assert f.read() == '# %%\na\nd\n# %%\nc\n'
+
+def test_journal_recovery(jupad: JupadTextEdit, qtbot: QtBot):
+    file_path = os.path.join(os.path.dirname(jupad.file_path), 'test_journal_recovery.py')
+    with open(file_path, 'w') as f:
+        f.write(test_file_content)
+    jupad.journal = True
+    jupad.open_file(file_path)
+    cursor = jupad.code_cell(2).lastCursorPosition()
+    cursor.insertText('2')
+    jupad.write_journal()
+    jupad.insert_cell(3)
+    jupad.textCursor().insertText('3')
+    jupad.write_journal()
+    jupad.save_pool.waitForDone()
+    # as if jupad crashed before saving
+    jupad.file_path = None
+    jupad.open_file(file_path)
+    assert [jupad.get_cell_code(i) for i in range(jupad.table.rows())] == ['0', '1\n1', '22', '3']
+    jupad.save_pool.waitForDone()
+    assert not os.path.exists(jupad.journal_path())
+    with open(file_path) as f:
+        assert f.read() == test_file_content.replace('2\n', '22\n# %%\n3\n')
+
+def test_external_change(jupad: JupadTextEdit, qtbot: QtBot):
+    file_path = os.path.join(os.path.dirname(jupad.file_path), 'test_external_change.py')
+    with open(file_path, 'w') as f:
+        f.write(test_file_content)
+    jupad.open_file(file_path)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(2) == '2')
+    execution_count = jupad.execution_count[0]
+    with open(file_path, 'w') as f:
+        f.write(test_file_content.replace('1\n1\n', '1\n# %%\n5\n'))
+    qtbot.waitUntil(lambda: jupad.table.rows() == 4)
+    assert [jupad.get_cell_code(i) for i in range(jupad.table.rows())] == ['0', '1', '5', '2']
+    qtbot.waitUntil(lambda: jupad.get_cell_out(2) == '5' and not jupad.execute_running)
+    # the unchanged first cell wasn't executed again
+    assert jupad.execution_count[0] == execution_count
+    # our own saves aren't taken as changes
+    jupad.textCursor().insertText('6')
+    jupad.save_file()
+    jupad.save_pool.waitForDone()
+    qtbot.wait(500)
+    assert jupad.table.rows() == 4
+    # the file is still watched after being replaced by the save
+    with open(file_path, 'w') as f:
+        f.write('# %%\n0\n')
+    qtbot.waitUntil(lambda: jupad.table.rows() == 1)
+    # unsaved edits are merged with the external change
+    jupad.save_timer.stop()
+    jupad.code_cell(0).lastCursorPosition().insertText('1')
+    with open(file_path, 'w') as f:
+        f.write('# %%\n0\n# %%\n7\n')
+    qtbot.waitUntil(lambda: jupad.table.rows() == 2)
+    assert [jupad.get_cell_code(i) for i in range(2)] == ['01', '7']
+
+def test_load_many_cells(jupad: JupadTextEdit, qtbot: QtBot):
+    file_path = os.path.join(os.path.dirname(jupad.file_path), 'test_load_many_cells.py')
+    content = ''.join(f'# %%\n{i}\n' for i in range(2000))
+    with open(file_path, 'w') as f:
+        f.write(content)
+    jupad.open_file(file_path)
+    # the rest are virtual until scrolled to
+    assert jupad.table.rows() == len(jupad.execution_count) == len(jupad.out_cell_cursor) == jupad.materialize_chunk
+    assert len(jupad.virtual_cells) == 2000 - jupad.materialize_chunk
+    assert jupad.get_cell_code(0) == '0'
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '0')
+    jupad.save_file()
+    jupad.save_pool.waitForDone()
+    with open(file_path, 'r') as f:
+        assert f.read() == content
+    jupad.verticalScrollBar().setValue(jupad.verticalScrollBar().maximum())
+    qtbot.waitUntil(lambda: jupad.table.rows() > jupad.materialize_chunk)
+    qtbot.keyClick(jupad, Qt.Key_A, Qt.ControlModifier)
+    assert jupad.table.rows() == len(jupad.execution_count) == 2000
+    assert jupad.virtual_cells == []
+    assert jupad.get_cell_code(1999) == '1999'
+    assert jupad.createMimeDataFromSelection().text() == ''.join(f'{i}\n' for i in range(2000))
+
+def test_paste(jupad: JupadTextEdit, qtbot: QtBot):
+    qtbot.keyClicks(jupad, 'x = 0 y')
+    cursor = jupad.textCursor()
+    cursor.movePosition(cursor.MoveOperation.Left, n=2)
+    jupad.setTextCursor(cursor)
+    mime_data = QMimeData()
+    mime_data.setText('a = 1\nb = (2,\n3)\nc = 3\n')
+    jupad.insertFromMimeData(mime_data)
+    assert [jupad.get_cell_code(i) for i in range(jupad.table.rows())] == ['x = 0', 'a = 1', 'b = (2,\n3)', 'c = 3', ' y']
+    assert jupad.table.cellAt(jupad.textCursor()).row() == 3
+    qtbot.waitUntil(lambda: jupad.get_cell_out(2) == '(2, 3)')
+
+def test_split_statements(jupad: JupadTextEdit):
+    lines = ['@decorator', 'def f():', '    a = 1', '', '    return a', 'x = f(); y = 2', '# comment', 'z = [', '1]', '']
+    assert jupad.split_statements(lines) == [
+        '@decorator\u2028def f():\u2028    a = 1\u2028\u2028    return a', 'x = f(); y = 2', '# comment', 'z = [\u20281]', '']
+    # lines copied from jupad cells are kept whole
+    assert jupad.split_statements(['a = 1\u2028b = 2', 'c = (3,', '4)']) == ['a = 1\u2028b = 2', 'c = (3,\u20284)']
+    # not python, by is_complete
+    assert jupad.split_statements(['%time x', 'if x:', '    y']) == ['%time x', 'if x:\u2028    y']
+    lines = [f'x{i} = {i}' for i in range(20000)]
+    assert jupad.split_statements(lines) == lines
+
+def test_highlighter_cache(jupad: JupadTextEdit, qtbot: QtBot, monkeypatch):
+    from pygments.token import String
+    jupad.textCursor().insertText('x = """a\nb"""')
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText('print(x)\nx')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(1) == 'a\nb\n\'a\\nb\'' and not jupad.execute_running)
+    string_format = jupad.highlighter._get_format(String)
+    assert jupad.code_cell(0).lastCursorPosition().block().layout().formats()[0].format == string_format
+    lexed = []
+    get_tokens = jupad.highlighter._lexer.get_tokens
+    monkeypatch.setattr(jupad.highlighter._lexer, 'get_tokens', lambda text: lexed.append(text) or get_tokens(text))
+    # output and cell colors don't lex code again
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    assert lexed == []
+    jupad.code_cell(1).lastCursorPosition().insertText('y')
+    assert lexed == ['xy']
+
+def test_highlighter_fallback(jupad: JupadTextEdit, qtbot: QtBot, monkeypatch):
+    from pygments.token import String
+    # a qtconsole without _lexpatch, blocks are highlighted by its own highlightBlock
+    monkeypatch.setattr(sys.modules['jupad'], '_lexpatch', None)
+    jupad.textCursor().insertText('x = """a\nb"""')
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText('x')
+    assert jupad.code_cell(0).lastCursorPosition().block().layout().formats()[0].format == jupad.highlighter._get_format(String)
+    assert jupad.get_codes() == ['x = """a\nb"""', 'x']
+    jupad.code_cell(1).lastCursorPosition().insertText('y')
+    assert jupad.get_codes() == ['x = """a\nb"""', 'xy']
+
+def test_is_complete(jupad: JupadTextEdit, qtbot: QtBot):
+    assert jupad.is_complete('if x:') == ('incomplete', 4)
+    assert jupad.is_complete_cache['if x:'] == ('incomplete', 4)
+    # kernels without a local check are asked, the brackets decide meanwhile
+    jupad.kernel_name = 'other'
+    assert jupad.is_complete('for i in x:') == ('complete', None)
+    qtbot.waitUntil(lambda: 'for i in x:' in jupad.is_complete_cache)
+    assert jupad.is_complete('for i in x:') == ('incomplete', 4)
+    # enter doesn't wait for a busy kernel
+    jupad.textCursor().insertText('import time\ntime.sleep(5)')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.running_msg_id != '')
+    jupad.insert_cell(1)
+    qtbot.keyClicks(jupad, 'while x:')
+    qtbot.keyClick(jupad, Qt.Key_Enter)
+    assert jupad.table.rows() == 3
+    assert jupad.execute_running
+
+def test_completion(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('abc_one = 1\nabc_two = 2')
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText('import time\ntime.sleep(5)')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '2' and jupad.execute_cell_idx == 1)
+    jupad.insert_cell(2)
+    qtbot.keyClicks(jupad, 'abc_')
+    # answered while the kernel is busy
+    qtbot.keyClick(jupad, Qt.Key_Tab)
+    qtbot.waitUntil(lambda: jupad.completion_cache is not None, timeout=2000)
+    assert jupad.execute_running
+    jupad.completion_widget.cancel_completion()
+    requests = []
+    kernel_request = jupad.kernel_request
+    jupad.kernel_request = lambda *args, **kwargs: requests.append(args) or kernel_request(*args, **kwargs)
+    # narrowed from the cache
+    qtbot.keyClicks(jupad, 't')
+    qtbot.keyClick(jupad, Qt.Key_Tab)
+    assert jupad.get_cell_code(2) == 'abc_two'
+    assert requests == []
+    # inspect waits for typing to pause
+    qtbot.keyClicks(jupad, '((')
+    assert requests == []
+    qtbot.waitUntil(lambda: requests == [('inspect_request',)])
+
+def test_undo_keeps_cells(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('1')
+    jupad.insert_cells(1, ['2', '3'])
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(2) == '3' and not jupad.execute_running)
+    jupad.setTextCursor(jupad.code_cell(1).lastCursorPosition())
+    qtbot.keyClick(jupad, Qt.Key_Enter)
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    execution_count = list(jupad.execution_count)
+    out_hash = list(jupad.out_hash)
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.table.rows() == 3
+    assert {len(getattr(jupad, name)) for name in ['execution_count', 'has_image', 'out_hash', 'latex', 'pending_newline',
+                                                    'truncated', 'out_cell_cursor', 'code_cache', 'out_key']} == {3}
+    assert jupad.execution_count[:2] == execution_count[:2]
+    # the row after the removed one keeps its state too
+    assert jupad.out_hash[2] == out_hash[3] and jupad.get_cell_out(2) == '3'
+    assert jupad.execution_count[0] is not None
+    assert jupad.cell_idx_and_pos_in_cell(jupad.textCursor()) == (1, 1)
+    qtbot.keyClick(jupad, Qt.Key_Y, Qt.ControlModifier)
+    assert [jupad.get_cell_code(i) for i in range(4)] == ['1', '2', '', '3']
+    assert jupad.execution_count[:2] == execution_count[:2]
+    # backspace merges into the previous cell
+    jupad.setTextCursor(jupad.code_cell(3).firstCursorPosition())
+    qtbot.keyClick(jupad, Qt.Key_Backspace)
+    assert jupad.get_codes() == ['1', '2', '3']
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_codes() == ['1', '2', '', '3']
+
+def test_undo_outputs(jupad: JupadTextEdit, qtbot: QtBot):
+    qtbot.keyClicks(jupad, '6*7')
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '42')
+    jupad.undo_history.last_push = 0 # a pause in typing
+    qtbot.keyClicks(jupad, '0')
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '420')
+    # outputs aren't in qt's undo stack
+    assert jupad.document().availableUndoSteps() == 0
+    jupad.kernel_client.execute = lambda *args, **kwargs: ''
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_cell_code(0) == '6*7'
+    assert jupad.get_cell_out(0) == '42' # from the cache, the kernel didn't answer
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_cell_code(0) == ''
+    qtbot.keyClick(jupad, Qt.Key_Y, Qt.ControlModifier)
+    qtbot.keyClick(jupad, Qt.Key_Y, Qt.ControlModifier)
+    assert jupad.get_cell_out(0) == '420'
+
+def test_undo_paths(jupad: JupadTextEdit, qtbot: QtBot):
+    qtbot.keyClicks(jupad, 'abc')
+    # the undo history is of the file it was recorded in
+    file_path = os.path.join(os.path.dirname(jupad.file_path), 'other.py')
+    with open(file_path, 'w') as f:
+        f.write('# %%\nkeep_me\n')
+    jupad.open_file(file_path)
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_codes() == ['keep_me']
+    # shift paste keeps the new lines in the cell, and is undone like any edit
+    QApplication.clipboard().setText('x = 1\ny = 2')
+    jupad.setTextCursor(jupad.code_cell(0).lastCursorPosition())
+    qtbot.keyClick(jupad, Qt.Key_V, Qt.ControlModifier | Qt.ShiftModifier)
+    assert jupad.get_codes() == ['keep_mex = 1\ny = 2']
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_codes() == ['keep_me']
+    qtbot.keyClick(jupad, Qt.Key_Y, Qt.ControlModifier)
+    assert jupad.get_codes() == ['keep_mex = 1\ny = 2']
+    # an edit that wasn't recorded makes the history out of date, it isn't applied over it
+    jupad.code_cell(0).firstCursorPosition().insertText('#')
+    qtbot.keyClick(jupad, Qt.Key_Z, Qt.ControlModifier)
+    assert jupad.get_codes() == ['#keep_mex = 1\ny = 2']
+
+def test_undo_history():
+    history = UndoHistory(max_entries=2, max_size=10)
+    history.push(UndoEntry(0, ['a'], ['ab'], (0, 1), (0, 2)))
+    history.push(UndoEntry(0, ['ab'], ['abc'], (0, 2), (0, 3))) # typing goes on, merged
+    assert len(history.undo_entries) == 1 and history.undo_entries[0].new == ['abc']
+    history.push(UndoEntry(1, [], ['x'], (0, 3), (1, 0)))
+    history.push(UndoEntry(2, [], ['y'], (1, 1), (2, 0)))
+    assert [entry.new for entry in history.undo_entries] == [['x'], ['y']]
+    assert history.undo().new == ['y']
+    history.push(UndoEntry(1, ['x'], ['x'*10], (1, 1), (1, 10))) # over max_size
+    assert history.redo() is None
+    assert [entry.new for entry in history.undo_entries] == [['x'*10]]
+    assert history.size == 11
+
+def test_input(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.replay_input = True
+    jupad.textCursor().insertText("x = input('name? ')\nx*2")
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == 'name? ')
+    jupad.setTextCursor(jupad.out_cell(0).lastCursorPosition())
+    qtbot.keyClicks(jupad, 'ab')
+    assert jupad.get_cell_out(0) == 'name? ab'
+    qtbot.keyClick(jupad, Qt.Key_Enter)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == "name? ab\n'abab'")
+    # answered again when executed again, showing it
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == "name? ab (previous answer)\n'abab'")
+    assert jupad.input_msg_id == ''
+    # output printed while waiting goes before the answer
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText("import threading\nthreading.Timer(0.5, print, ['tick']).start()\ny = input('again? ')\n'<'+y+'>'")
+    jupad.execute(1)
+    qtbot.waitUntil(lambda: jupad.input_msg_id != '')
+    jupad.setTextCursor(jupad.out_cell(1).lastCursorPosition())
+    qtbot.keyClicks(jupad, 'c')
+    qtbot.waitUntil(lambda: jupad.get_cell_out(1) == 'again? tickc')
+    qtbot.keyClick(jupad, Qt.Key_Backspace)
+    # executions don't cancel it, edits of the cells after it do
+    jupad.insert_cell(2)
+    jupad.execute(2)
+    assert jupad.input_msg_id != ''
+    qtbot.keyClicks(jupad, '3')
+    qtbot.waitUntil(lambda: jupad.get_cell_out(2) == '3')
+    assert jupad.get_cell_out(1) == "again? tick\n\n'<>'"
+    # and so does the timeout
+    jupad.input_timeout = 0.1
+    jupad.execute(1)
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    assert jupad.get_cell_out(1).endswith("\n'<>'")
+
+def test_latex_cache():
+    tmp_dir = tempfile.mkdtemp(prefix='jupad_')
+    cache = LatexCache(tmp_dir, max_entries=1)
+    key = cache.key('x^2', 'Black', 1.0)
+    assert key != cache.key('x^2', 'White', 1.0)
+    assert cache.get(key) is None
+    cache.put(key, b'png')
+    cache.put(cache.key('y', 'Black', 1.0), b'png2') # evicts key from memory
+    assert cache.get_from_memory(key) is None
+    assert cache.get(key) == b'png' # from disk
+    assert cache.get_from_memory(key) == b'png'
+    # the disk is pruned of the least recently used
+    cache.max_disk_entries = 2
+    os.utime(os.path.join(tmp_dir, key + '.png'), (0, 0))
+    os.utime(os.path.join(tmp_dir, cache.key('y', 'Black', 1.0) + '.png'), (1, 1))
+    cache.put(cache.key('z', 'Black', 1.0), b'png3')
+    assert sorted(os.listdir(tmp_dir)) == [cache.key('z', 'Black', 1.0) + '.png']
+    shutil.rmtree(tmp_dir)
+
+def test_svg(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText("from IPython.display import SVG\n"
+        "SVG('<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"4000\" height=\"100\"><rect width=\"4000\" height=\"100\"/></svg>')")
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.has_image[0])
+    name, = jupad.svg_images
+    image = jupad.document().resource(jupad.document().ImageResource, QUrl(name))
+    assert image.width() / image.devicePixelRatio() <= jupad.out_column_width()
+
+def test_truncated_output(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('list(range(10000))')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.truncated[0])
+    assert len(jupad.get_cell_out(0)) < len(str(list(range(10000))))
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    jupad.request_full_output(0)
+    qtbot.waitUntil(lambda: not jupad.truncated[0] and '999' in jupad.get_cell_out(0))
+
+def test_prune_history(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('1')
+    for i in range(3):
+        jupad.execute(0)
+        qtbot.waitUntil(lambda: not jupad.execute_running)
+    client = jupad.kernel_manager.blocking_client()
+    client.start_channels()
+    reply = client.execute('', silent=True, reply=True, timeout=5, user_expressions={
+        'out': 'sorted(Out)', 'inputs': '[n for n, code in enumerate(In) if code]',
+        'db_cache': 'len(get_ipython().history_manager.db_input_cache)'})
+    client.stop_channels()
+    user_expressions = reply['content']['user_expressions']
+    assert user_expressions['out']['data']['text/plain'] == str([jupad.execution_count[0]])
+    assert user_expressions['inputs']['data']['text/plain'] == str([jupad.execution_count[0]])
+    assert user_expressions['db_cache']['data']['text/plain'] == '0'
+
+def test_image(jupad: JupadTextEdit, qtbot: QtBot):
+    image = QImage(2, 3, QImage.Format.Format_RGB32)
+    image.fill(Qt.GlobalColor.red)
+    png = QByteArray()
+    buffer = QBuffer(png)
+    buffer.open(QBuffer.OpenModeFlag.WriteOnly)
+    image.save(buffer, 'PNG')
+    jupad.textCursor().insertText(f"from IPython.display import Image\nImage(data=__import__('base64').b64decode('{base64.b64encode(bytes(png)).decode()}'))")
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.has_image[0])
+    name = jupad.execute_msg_id
+    assert jupad.document().resource(jupad.document().ImageResource, QUrl(name)).size() == image.size()
+
+def test_figure_size(jupad: JupadTextEdit, qtbot: QtBot):
+    image = QImage(4, 2, QImage.Format.Format_RGB32)
+    image.fill(Qt.GlobalColor.red)
+    png = QByteArray()
+    buffer = QBuffer(png)
+    buffer.open(QBuffer.OpenModeFlag.WriteOnly)
+    image.save(buffer, 'PNG')
+    # shown at the width of its metadata
+    jupad.textCursor().insertText(f"from IPython.display import Image\nImage(data=__import__('base64').b64decode('{base64.b64encode(bytes(png)).decode()}'), width=2)")
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.has_image[0])
+    assert jupad.document().resource(jupad.document().ImageResource, QUrl(jupad.execute_msg_id)).devicePixelRatio() == 2
+    # the kernel knows the output column
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText("config = get_ipython().config.InlineBackend\n"
+                                  "config.rc.to_dict()['update']['figure.figsize'][0] * 96, config.print_figure_kwargs.to_dict()['update']")
+    jupad.execute(1)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(1) == f"({float(jupad.out_column_width())}, {{'dpi': {96 * jupad.devicePixelRatioF()}}})")
+    # settings of the user stay
+    jupad.insert_cell(2)
+    jupad.textCursor().insertText("config.rc.update({'figure.figsize': [1, 2]})")
+    jupad.execute(2)
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    jupad.recalculate_columns()
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    assert jupad.get_cell_out(1) == f"(96, {{'dpi': {96 * jupad.devicePixelRatioF()}}})"
+
+def test_unchanged_output(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.textCursor().insertText('print(1)\n(1,2)')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '1\n(1, 2)')
+    changes = []
+    jupad.document().contentsChange.connect(lambda pos, removed, added: changes.append(pos))
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: not jupad.execute_running and not jupad.output_stages)
+    out_cell = jupad.out_cell(0)
+    assert not [pos for pos in changes if out_cell.firstCursorPosition().position() <= pos <= out_cell.lastCursorPosition().position()]
+
+def test_timeout(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.execute_timeout = 1
+    jupad.timeout_grace = 1000
+    jupad.textCursor().insertText('while True: pass')
+    jupad.insert_cell(1)
+    jupad.textCursor().insertText('import signal\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\nwhile True: pass')
+    jupad.execute(0)
+    # first cell is interrupted, second ignores interrupts and gets the kernel restarted
+    qtbot.waitUntil(lambda: jupad.get_cell_out(1).startswith('TimeoutError'), timeout=20000)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0).startswith('KeyboardInterrupt'))
+    assert jupad.execution_count[1] is None
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='kernel limits and SIGKILL are linux only')
+def test_kernel_died(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.memory_limit = 4096
+    jupad.limit_kernel()
+    qtbot.waitUntil(lambda: 'MB / 4096 MB' in jupad.parent().windowTitle())
+    jupad.textCursor().insertText('import os, signal\nos.kill(os.getpid(), signal.SIGKILL)')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0).startswith('KernelDied'), timeout=20000)
+    assert '4096 MB memory' in jupad.get_cell_out(0)
+
+def test_spare_kernel(jupad: JupadTextEdit, qtbot: QtBot):
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    jupad.start_spare_kernel()
+    qtbot.waitUntil(jupad.kernel_pool.full, timeout=10000)
+    spare_pid = jupad.kernel_pool.kernels[0][1].provisioner.pid
+    jupad.textCursor().insertText('import os\nos.getpid(), "COLUMNS" in os.environ')
+    jupad.execute(0)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0).endswith('True)'))
+    assert str(spare_pid) not in jupad.get_cell_out(0)
+    jupad.restart_kernel()
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == f'({spare_pid}, True)')
+    # no spare, the kernel is launched in the background
+    jupad.spare_kernel_timer.stop()
+    jupad.restart_kernel()
+    assert jupad.kernel_client is None and jupad.kernel_launcher is not None
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0).endswith('True)') and str(spare_pid) not in jupad.get_cell_out(0), timeout=10000)
+
+def test_kernel_pool(jupad: JupadTextEdit, qtbot: QtBot):
+    jupad.start_spare_kernel()
+    jupad.start_spare_kernel() # already starting
+    qtbot.waitUntil(jupad.kernel_pool.full, timeout=10000)
+    spare_kernel_manager = jupad.kernel_pool.kernels[0][1]
+    jupad.start_spare_kernel() # the pool is full
+    assert len(jupad.kernel_pool.kernels) == 1
+    # another pad takes the spare
+    cwd = os.path.dirname(jupad.file_path)
+    window = MainWindow(file_path=os.path.join(cwd, 'other.py'), kernel_pool=jupad.kernel_pool, cwd=cwd)
+    other = window.jupad_text_edit
+    try:
+        assert other.kernel_manager is spare_kernel_manager
+        assert jupad.kernel_pool.kernels == []
+        other.textCursor().insertText('import os\nos.getcwd()')
+        qtbot.waitUntil(lambda: other.get_cell_out(0) == repr(cwd), timeout=5000)
+    finally:
+        window.close()
+    assert not other.own_kernel_pool and not spare_kernel_manager.is_alive()
+
+def test_instance(qtbot: QtBot):
+    from jupad.instance import InstanceServer
+    name = f'jupad-test-{os.getpid()}'
+    server = InstanceServer(name)
+    assert server.listen()
+    requests = []
+    server.open_requested.connect(requests.append)
+    process = subprocess.Popen([sys.executable, '-c', 'import sys\nfrom jupad.instance import send_to_instance\n'
+                                f'sys.exit(0 if send_to_instance({{"file_path": "a.py"}}, {name!r}) else 1)'])
+    qtbot.waitUntil(lambda: process.poll() is not None, timeout=10000)
+    assert process.returncode == 0
+    assert requests == [{'file_path': 'a.py'}]
+    # only pad arguments are accepted
+    process = subprocess.Popen([sys.executable, '-c', 'import sys\nfrom jupad.instance import send_to_instance\n'
+                                f'sys.exit(0 if send_to_instance({{"file_path": "b.py", "parent": None}}, {name!r}) else 1)'],
+                               stderr=subprocess.PIPE)
+    qtbot.waitUntil(lambda: process.poll() is not None, timeout=10000)
+    assert process.returncode == 1
+    assert b'unknown argument parent' in process.stderr.read()
+    assert requests == [{'file_path': 'a.py'}]
+    # a running instance keeps its socket
+    assert not InstanceServer(name).listen()
+    server.server.close()
+
+def test_daemon_kernel(jupad: JupadTextEdit, qtbot: QtBot, tmp_path, monkeypatch):
+    from jupad import daemon
+    monkeypatch.setattr(daemon, 'daemon_dir', str(tmp_path))
+    kernel_daemon = daemon.KernelDaemon()
+    kernel_daemon.poll()
+    (daemon_kernel_manager,) = kernel_daemon.ready.values()
+    qtbot.waitUntil(lambda: not jupad.execute_running)
+    jupad.textCursor().insertText('import os\nos.getpid()')
+    jupad.restart_kernel()
+    daemon_pid = str(daemon_kernel_manager.provisioner.pid)
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == daemon_pid, timeout=10000)
+    kernel_daemon.poll()
+    assert kernel_daemon.claimed == [daemon_kernel_manager]
+    # a process that took over the pid isn't the kernel
+    assert daemon.kernel_alive(daemon_kernel_manager.provisioner.pid, daemon_kernel_manager.connection_file)
+    assert not daemon.kernel_alive(os.getpid(), daemon_kernel_manager.connection_file)
+    kernel_daemon.stop()
+    for kernel_manager in kernel_daemon.ready.values():
+        kernel_manager.shutdown_kernel(now=True)
+
+def test_import_time():
+    # jupad's hard dependencies are imported first, what jupad takes on top of them is its own cost
+    dependencies = ['PyQt6.QtWidgets', 'qtpy.QtCore', 'qtconsole.pygments_highlighter', 'qtconsole.base_frontend_mixin']
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {", ".join(dependencies)}; import jupad'],
+                            capture_output=True, text=True, check=True)
+    # import time:  self [us] | cumulative | imported package
+    imported = {line.split('|')[2].strip(): int(line.split('|')[1]) for line in result.stderr.splitlines()[1:]}
+    # loaded on first use, the kernel ones in the background, by the kernel launcher
+    for module in ['qtconsole.completion_widget', 'qtconsole.call_tip_widget', 'qtconsole.ansi_code_processor',
+                   'ansi2html', 'PyQt6.QtSvg', 'IPython', 'matplotlib',
+                   'qtconsole.manager', 'qtconsole.client', 'jupyter_client', 'zmq', 'jupad.kernels']:
+        assert module not in imported
+    assert imported['jupad'] < sum(imported[module] for module in dependencies) / 2
+
+def test_edit_before_kernel_ready(qtbot: QtBot):
+    tmp_dir = tempfile.mkdtemp(prefix='jupad_')
+    window = MainWindow(file_path=os.path.join(tmp_dir,'jupad.py'))
+    jupad = window.jupad_text_edit
+    # kernel still boots, edits are queued
+    assert not jupad.kernel_ready()
+    qtbot.keyClicks(jupad, '1+1')
+    assert not jupad.execute_running
+    qtbot.waitUntil(lambda: jupad.get_cell_out(0) == '2', timeout=10000)
+    window.close()
+    shutil.rmtree(tmp_dir)